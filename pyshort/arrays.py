@@ -6,6 +6,7 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 from future_builtins import *  # ascii, filter, hex, map, oct, zip
 
 import numpy as np
+import tempfile
 import unittest
 
 
@@ -24,6 +25,172 @@ def map_to_small_integers(arr, return_index=False):
         return inverse
 
 
+class SmallIntegerEncoder(object):
+    """Stateful version of map_to_small_integers(), for encoding a stream of chunks (for example daily files).
+
+    Each new value gets the next integer, counting from 0 in order of first appearance, and keeps it in later calls.
+    Integer values are looked up in a direct table indexed by value, which is O(n) per chunk, as long as the
+    range of values fits in MAX_TABLE_SIZE. Other values (strings, floats, very sparse integers) are looked up by
+    binary search in a sorted copy of the vocabulary, after np.unique() on the chunk.
+    The vocabulary can be saved and loaded with save() and load().
+    """
+
+    MAX_TABLE_SIZE = 1 << 24  # Entries in the integer lookup table, 64 MB of int32.
+
+    def __init__(self, values=None):
+        """Values is an optional initial vocabulary, with values[i] encoded as i."""
+        self.values = np.array([]) if values is None else np.asarray(values)
+        self._sorted_codes = np.argsort(self.values, kind='mergesort').astype(np.int32)
+        self._sorted_values = self.values[self._sorted_codes]
+        self._table = None  # Code for each integer value from self._table_lo, or -1.
+        self._table_lo = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def encode(self, arr, grow=True, sorted_order=False):
+        """Returns an int32 array of len(arr) with the code of each element.
+
+        If grow is False, unseen values are encoded as -1 instead of being added to the vocabulary.
+        If sorted_order is True, returns codes counting in sorted order of the current vocabulary instead,
+        like map_to_small_integers() over everything encoded so far. These change when the vocabulary grows.
+        """
+        arr = np.asarray(arr)
+        codes = None
+        if arr.dtype.kind in 'iu' and len(arr):
+            codes = self._table_lookup(arr)
+        if codes is None:
+            codes = self._sorted_lookup(arr)
+
+        missing = codes < 0
+        if grow and missing.any():
+            codes[missing] = self._add(arr[missing])
+
+        if sorted_order:
+            ranks = np.empty(len(self.values), dtype=np.int32)
+            ranks[self._sorted_codes] = np.arange(len(self.values), dtype=np.int32)
+            codes = np.where(codes >= 0, ranks[codes], -1).astype(np.int32)
+        return codes
+
+    def decode(self, codes):
+        """Returns the values for an array of codes."""
+        return self.values[codes]
+
+    def save(self, filename):
+        """Saves the vocabulary as a .npy file."""
+        np.save(filename, self.values)
+
+    @classmethod
+    def load(cls, filename):
+        return cls(np.load(filename, allow_pickle=True))
+
+    def _table_lookup(self, arr):
+        """Returns codes (-1 for unseen) using the integer table, or None if the values don't fit in one."""
+        lo, hi = int(arr.min()), int(arr.max())
+        if len(self.values):
+            if self.values.dtype.kind not in 'iu':
+                return None
+            lo, hi = min(lo, int(self._sorted_values[0])), max(hi, int(self._sorted_values[-1]))
+        if hi - lo >= self.MAX_TABLE_SIZE:
+            return None
+        if self._table is None or lo < self._table_lo or hi >= self._table_lo + len(self._table):
+            self._table = np.full(hi - lo + 1, -1, dtype=np.int32)
+            self._table_lo = lo
+            self._table[self._sorted_values.astype(np.int64) - lo] = self._sorted_codes
+        return self._table[arr.astype(np.int64) - self._table_lo]
+
+    def _sorted_lookup(self, arr):
+        """Returns codes (-1 for unseen) by binary search of the unique values of arr."""
+        unique, inverse = np.unique(arr, return_inverse=True)
+        if not len(self.values):
+            return np.full(len(arr), -1, dtype=np.int32)
+        pos = np.minimum(np.searchsorted(self._sorted_values, unique), len(self.values) - 1)
+        unique_codes = np.where(self._sorted_values[pos] == unique, self._sorted_codes[pos], -1).astype(np.int32)
+        return unique_codes[inverse]
+
+    def _add(self, new):
+        """Adds values not yet in the vocabulary, returns their codes."""
+        new_values, first_index, inverse = np.unique(new, return_index=True, return_inverse=True)
+        order = np.argsort(first_index)  # Unique values in order of first appearance.
+        new_codes = np.empty(len(new_values), dtype=np.int32)
+        new_codes[order] = np.arange(len(self.values), len(self.values) + len(new_values), dtype=np.int32)
+
+        if len(self.values):
+            insert_at = np.searchsorted(self._sorted_values, new_values)
+            # np.insert keeps the old dtype, which would truncate longer strings.
+            dtype = np.promote_types(self._sorted_values.dtype, new_values.dtype)
+            self._sorted_values = np.insert(self._sorted_values.astype(dtype), insert_at, new_values)
+            self._sorted_codes = np.insert(self._sorted_codes, insert_at, new_codes)
+            self.values = np.concatenate((self.values, new_values[order]))
+        else:
+            # The empty initial vocabulary has no useful dtype, take it from the first values.
+            self._sorted_values = new_values
+            self._sorted_codes = new_codes
+            self.values = new_values[order]
+
+        if self._table is not None:
+            if new_values.dtype.kind in 'iu' and new_values[0] >= self._table_lo and new_values[-1] < self._table_lo + len(self._table):
+                self._table[new_values.astype(np.int64) - self._table_lo] = new_codes
+            else:
+                self._table = None  # Rebuilt on the next integer lookup.
+        return new_codes[inverse]
+
+
+def sliding_windows(arr, n=2):
+    """Returns a read-only view of shape (len(arr) - n + 1, n) with all windows of n successive elements.
+    Array version of iterables.successive(), without copying: row i is arr[i:i + n].
+
+    Useful for vectorized deltas or "surrounding context", for example sliding_windows(arr, 3).mean(axis=1).
+    Extra dimensions of arr are kept after the window dimension. Returns shape (0, n) if arr is shorter than n.
+    """
+    assert n > 0
+    arr = np.asarray(arr)
+    num = max(len(arr) - n + 1, 0)
+    return np.lib.stride_tricks.as_strided(arr, shape=(num, n) + arr.shape[1:], strides=(arr.strides[0],) + arr.strides,
+                                           writeable=False)
+
+
+def ragged_offsets(rows):
+    """Packs a list of 1D sequences of different lengths into (values, offsets) for ragged_percentiles().
+    Row i is values[offsets[i]:offsets[i + 1]].
+    """
+    lengths = np.array([len(r) for r in rows], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths)))
+    values = np.concatenate([np.asarray(r, dtype=np.float64) for r in rows]) if len(rows) else np.array([])
+    return values, offsets
+
+
+def ragged_percentiles(values, offsets, percentiles):
+    """Percentiles of each row of a ragged 2D array, equal to np.percentile() of each row separately.
+
+    values is a flat array of all rows, and row i is values[offsets[i]:offsets[i + 1]], see ragged_offsets().
+    percentiles is a sequence of numbers in [0, 100].
+    Returns a float64 array of shape (len(percentiles), number of rows), like np.percentile(arr, percentiles, axis=1).
+    Each row is sorted once (all together, in a single lexsort), then all percentiles are interpolated at once.
+    Empty rows give nan.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    percentiles = np.asarray(percentiles, dtype=np.float64)
+    starts = offsets[:-1]
+    lengths = np.diff(offsets)
+    row_ids = np.repeat(np.arange(len(lengths)), lengths)
+    sorted_values = values[offsets[0]:offsets[-1]][np.lexsort((values[offsets[0]:offsets[-1]], row_ids))]
+    starts = starts - offsets[0]
+
+    # Same linear interpolation as np.percentile: position p / 100 * (n - 1) within each row.
+    position = percentiles[:, np.newaxis] / 100 * np.maximum(lengths - 1, 0)[np.newaxis, :]
+    below = np.floor(position).astype(np.int64)
+    above = np.minimum(below + 1, np.maximum(lengths - 1, 0)[np.newaxis, :])
+    weight_above = position - below
+    if not len(sorted_values):
+        return np.full(position.shape, np.nan)
+    safe = lambda idx: np.minimum(starts[np.newaxis, :] + idx, len(sorted_values) - 1)
+    result = sorted_values[safe(below)] * (1 - weight_above) + sorted_values[safe(above)] * weight_above
+    result[:, lengths == 0] = np.nan
+    return result
+
+
 def split_nonzero(arr):
     """Yields [start,end) indexes for sections where the boolean array is zero.
 
@@ -36,21 +203,64 @@ def split_nonzero(arr):
     arr = arr.astype(bool)
     arr = arr.astype('int8')
     diff = np.diff(arr)  # -1, 0 and 1
-    idxs, = np.nonzero(diff)  # Indexes of -1 and 1
+    # Changed from nonzero to zero: start of new split. Changed from zero to nonzero: end of a split.
+    starts, = np.nonzero(diff == -1)
+    ends, = np.nonzero(diff == 1)
+    ends += 1
+    # Transitions alternate, so starts and ends pair up once the first and last sections are added.
+    if not arr[0]:
+        starts = np.concatenate(([0], starts))
+    if not arr[-1]:
+        ends = np.concatenate((ends, [len(arr)]))
+    keep = ends - starts >= 2
 
-    splits = []
-    start = 0
+    if not keep.any():
+        return np.array([], dtype=int)
+    return np.column_stack((starts[keep], ends[keep])).astype(int)
 
-    for idx in idxs:
-        if diff[idx] == -1:  # Changed from nonzero to zero. Start of new split.
-            start = idx
-        elif idx > start:  # Changed from zero to nonzero. End of a split if it isn't too short
-            splits.append((start, idx + 1))
-    # If ended on a zero, perhaps add last slice.
-    if not arr[-1]:
-        splits.append((start, len(arr)))
 
-    return np.array(splits, dtype=int)
+def split_nonzero_chunks(chunks, chunk_size=1 << 20):
+    """Streaming version of split_nonzero(), for arrays larger than memory.
+
+    chunks is an iterable of 1D arrays, or a single array (for example np.memmap) which is read chunk_size elements at a time.
+    Yields an int array of [start,end) pairs after each chunk, with indexes into the whole concatenated stream.
+    Sections crossing chunk boundaries are yielded once they end. Concatenating the results equals split_nonzero().
+    """
+    if isinstance(chunks, np.ndarray):
+        arr = chunks
+        chunks = (arr[i:i + chunk_size] for i in xrange(0, len(arr), chunk_size))
+
+    offset = 0  # Stream index of the current chunk start.
+    prev = None  # Last element of the previous chunk, as 0 or 1.
+    start = 0  # Start of the section which is open at the end of the previous chunk.
+    for chunk in chunks:
+        if not len(chunk):
+            continue
+        chunk = np.asarray(chunk).astype(bool).astype('int8')
+        if prev is None:
+            ext, base = chunk, offset
+        else:
+            ext, base = np.concatenate(([prev], chunk)), offset - 1
+        diff = np.diff(ext)
+        starts, = np.nonzero(diff == -1)
+        ends, = np.nonzero(diff == 1)
+        starts += base
+        ends += base + 1
+        if prev is None and not chunk[0]:
+            starts = np.concatenate(([start], starts))
+        elif len(ends) and (not len(starts) or ends[0] <= starts[0]):
+            starts = np.concatenate(([start], starts))  # First end closes the section open from earlier chunks.
+        if len(starts) > len(ends):
+            start = starts[-1]
+        starts = starts[:len(ends)]
+        keep = ends - starts >= 2
+        yield np.column_stack((starts[keep], ends[keep])).astype(int)
+
+        offset += len(chunk)
+        prev = chunk[-1]
+
+    if prev is not None and not prev and offset - start >= 2:
+        yield np.array([(start, offset)], dtype=int)
 
 
 class MapToSmallIntegersTest(unittest.TestCase):
@@ -75,6 +285,112 @@ class MapToSmallIntegersTest(unittest.TestCase):
         self.assertArrEq([1, 0, 2], indices)
 
 
+class SmallIntegerEncoderTest(unittest.TestCase):
+    def assertArrEq(self, a, b):
+        self.assertEqual(list(a), list(b))
+
+    def test_first_seen_order(self):
+        enc = SmallIntegerEncoder()
+        self.assertArrEq([0, 1, 2, 1, 0], enc.encode(np.array([5, 3, 7, 3, 5])))
+        self.assertArrEq([2, 3, 0, 4], enc.encode(np.array([7, 1, 5, 9])))
+        self.assertArrEq([5, 3, 7, 1, 9], enc.decode(np.arange(5)))
+
+    def test_empty(self):
+        enc = SmallIntegerEncoder()
+        self.assertArrEq([], enc.encode(np.array([], dtype=int)))
+        self.assertArrEq([0], enc.encode(np.array([4])))
+
+    def test_no_grow(self):
+        enc = SmallIntegerEncoder()
+        enc.encode(np.array([5, 3]))
+        self.assertArrEq([1, -1, 0], enc.encode(np.array([3, 4, 5]), grow=False))
+        self.assertEqual(2, len(enc))
+
+    def test_sorted_order(self):
+        enc = SmallIntegerEncoder()
+        enc.encode(np.array([5, 3]))
+        arr = np.array([5, 3, 7, 3, 5])
+        self.assertArrEq(map_to_small_integers(arr), enc.encode(arr, sorted_order=True))
+
+    def test_strings(self):
+        enc = SmallIntegerEncoder()
+        self.assertArrEq([0, 1, 0], enc.encode(np.array(['b', 'a', 'b'])))
+        self.assertArrEq([2, 1], enc.encode(np.array(['longer', 'a'])))
+        self.assertArrEq([2, -1], enc.encode(np.array(['longer', 'l']), grow=False))
+
+    def test_random_matches_unique(self):
+        rng = np.random.RandomState(0)
+        enc = SmallIntegerEncoder()
+        chunks = [rng.randint(0, 1000, size=300) for i in xrange(5)]
+        codes = np.concatenate([enc.encode(c) for c in chunks])
+        self.assertArrEq(np.concatenate(chunks), enc.decode(codes))
+        whole = np.concatenate(chunks)
+        self.assertArrEq(map_to_small_integers(whole), enc.encode(whole, sorted_order=True))
+
+    def test_sparse_integers(self):
+        enc = SmallIntegerEncoder()
+        self.assertArrEq([0, 1, 0], enc.encode(np.array([10 ** 12, 3, 10 ** 12])))
+        self.assertArrEq([2, 1], enc.encode(np.array([-5, 3])))
+        self.assertArrEq([10 ** 12, 3, -5], enc.decode(np.arange(3)))
+
+    def test_table_grows(self):
+        enc = SmallIntegerEncoder()
+        enc.encode(np.array([5, 6]))
+        self.assertArrEq([2, 0, 3], enc.encode(np.array([100, 5, -100])))
+        self.assertArrEq([3, 2, 1], enc.encode(np.array([-100, 100, 6])))
+
+    def test_save_load(self):
+        enc = SmallIntegerEncoder()
+        enc.encode(np.array([5, 3, 7]))
+        f = tempfile.NamedTemporaryFile(suffix='.npy')
+        enc.save(f.name)
+        loaded = SmallIntegerEncoder.load(f.name)
+        self.assertArrEq([2, 0, 3], loaded.encode(np.array([7, 5, 8])))
+
+
+class SlidingWindowsTest(unittest.TestCase):
+    def test_pairs(self):
+        windows = sliding_windows(np.arange(4))
+        self.assertEqual([[0, 1], [1, 2], [2, 3]], windows.tolist())
+        self.assertFalse(windows.flags.writeable)
+
+    def test_short(self):
+        self.assertEqual((0, 3), sliding_windows(np.arange(2), 3).shape)
+        self.assertEqual((1, 3), sliding_windows(np.arange(3), 3).shape)
+
+    def test_no_copy(self):
+        arr = np.arange(10.0)
+        windows = sliding_windows(arr, 4)
+        arr[5] = -1
+        self.assertEqual(-1, windows[2, 3])
+
+    def test_2d(self):
+        arr = np.arange(8).reshape(4, 2)
+        windows = sliding_windows(arr, 2)
+        self.assertEqual((3, 2, 2), windows.shape)
+        self.assertEqual([[2, 3], [4, 5]], windows[1].tolist())
+
+
+class RaggedPercentilesTest(unittest.TestCase):
+    def test_matches_numpy(self):
+        rng = np.random.RandomState(0)
+        rows = [rng.normal(size=rng.randint(1, 50)) for i in xrange(30)] + [[5.0], [1.0, 1.0]]
+        percentiles = [0, 5, 12.5, 50, 95, 100]
+        values, offsets = ragged_offsets(rows)
+        expected = np.array([np.percentile(r, percentiles) for r in rows]).T
+        np.testing.assert_allclose(expected, ragged_percentiles(values, offsets, percentiles))
+
+    def test_offsets_into_larger_array(self):
+        values = np.array([9.0, 3.0, 1.0, 2.0, 9.0])
+        self.assertEqual([[1.0], [2.0], [3.0]], ragged_percentiles(values, [1, 4], [0, 50, 100]).tolist())
+
+    def test_empty_rows(self):
+        result = ragged_percentiles(np.array([1.0, 3.0]), [0, 0, 2], [50])
+        self.assertTrue(np.isnan(result[0, 0]))
+        self.assertEqual(2.0, result[0, 1])
+        self.assertTrue(np.isnan(ragged_percentiles(np.array([]), [0, 0], [50])).all())
+
+
 class SplitNonzeroTest(unittest.TestCase):
 
     def assertSplit(self, expected_indices, argument):
@@ -126,5 +442,35 @@ class SplitNonzeroTest(unittest.TestCase):
     def test_all_zero(self):
         self.assertSplit([(0, 5)], [0, 0, 0, 0, 0])
 
+
+class SplitNonzeroChunksTest(unittest.TestCase):
+
+    def assertChunked(self, arr, chunk_size):
+        expect = split_nonzero(arr).reshape(-1, 2)
+        result = np.concatenate([np.empty((0, 2), dtype=int)] + list(split_nonzero_chunks(arr, chunk_size=chunk_size)))
+        self.assertTrue(np.array_equal(expect, result),
+                        'Chunk size {}, array\n{}\nexpected\n{}\ngot\n{}'.format(chunk_size, arr, expect, result))
+
+    def test_empty(self):
+        self.assertEqual([], list(split_nonzero_chunks([])))
+        self.assertEqual([], list(split_nonzero_chunks(np.array([]))))
+
+    def test_small(self):
+        for arr in [[0], [5], [0, 0], [3, 0], [0, 4], [0, 0, 3, 0, 0, 3, 0], [0, 3, 0, 3, 3, 0], [1, 5, 0, 2]]:
+            for chunk_size in xrange(1, len(arr) + 1):
+                self.assertChunked(np.array(arr), chunk_size)
+
+    def test_random(self):
+        rng = np.random.RandomState(0)
+        for density in [0.1, 0.5, 0.9]:
+            arr = (rng.random_sample(500) < density).astype(int)
+            for chunk_size in [1, 2, 3, 7, 64, 500]:
+                self.assertChunked(arr, chunk_size)
+
+    def test_iterable_of_chunks(self):
+        chunks = [np.array([0, 0]), np.array([]), np.array([3]), np.array([0, 0, 0])]
+        result = np.concatenate(list(split_nonzero_chunks(iter(chunks))))
+        self.assertTrue(np.array_equal([(0, 2), (2, 6)], result))
+
 if __name__ == '__main__':
     unittest.main()
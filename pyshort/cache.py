@@ -4,37 +4,1041 @@ Useful for slow data-parsing code.
 from __future__ import absolute_import, division, print_function, unicode_literals
 from future_builtins import *  # ascii, filter, hex, map, oct, zip
 
+import bz2
+import collections
+import contextlib
 import cPickle
+import cStringIO
 from decorator import decorator
+import fcntl
+import hashlib
+import heapq
+import inspect
+import multiprocessing
+import numpy as np
 import os
+import shutil
 import sys
+import tempfile
+import thread
+import threading
+import time
+import unittest
+import zlib
+
+try:
+    import lzma  # Python 3.3+, or the backports.lzma package.
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 CACHES_BASE = '/local/scratch/ml421/caches'
+INDEX_FILENAME = 'index.pickle'
+INDEX_LOG_FILENAME = 'index.log'
+_INDEX_LOG_COMPACT_BYTES = 1 << 20
+
+
+def cache_key(func, args, kwargs):
+    """Returns a stable hex digest of the function identity and all of its arguments.
+
+    Arguments are bound to parameter names first, so f(1, b=2) and f(1, 2) get the same key.
+    All arguments must be picklable, and should pickle deterministically (no sets or large dicts).
+    """
+    callargs = inspect.getcallargs(func, *args, **kwargs)
+    ident = (func.__module__, func.__name__, sorted(callargs.items()))
+    return hashlib.sha1(cPickle.dumps(ident, 2)).hexdigest()
+
+
+class CacheStats(object):
+    """Counters for one DiskCache. Use them to size max_bytes and max_entries from real numbers."""
+
+    FIELDS = ('hits', 'memory_hits', 'misses', 'evictions', 'bytes_read', 'bytes_written')
+
+    def __init__(self):
+        for name in self.FIELDS:
+            setattr(self, name, 0)
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.FIELDS)
+
+    def __repr__(self):
+        return 'CacheStats({0})'.format(', '.join('{0}={1}'.format(name, getattr(self, name)) for name in self.FIELDS))
+
+
+class MemoryCache(object):
+    """In-process LRU of already loaded objects, in front of a DiskCache.
+
+    Each entry remembers the mtime of the file it was loaded from, and is only returned if the file still has that mtime.
+    This way another process rewriting the entry invalidates the memory copy.
+    If ttl (seconds) is given, entries older than that are dropped as well.
+    """
+
+    def __init__(self, max_items, ttl=None):
+        assert max_items > 0
+        self.max_items = max_items
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()  # key -> (data, mtime, time stored). Oldest first.
+
+    def get(self, key, mtime):
+        """Returns data for key if loaded from a file with this mtime. Raises KeyError otherwise."""
+        data, entry_mtime, stored = self._entries.pop(key)
+        if entry_mtime != mtime or (self.ttl is not None and time.time() - stored > self.ttl):
+            raise KeyError(key)
+        self._entries[key] = (data, entry_mtime, stored)  # Re-insert as most recently used.
+        return data
+
+    def put(self, key, data, mtime):
+        self._entries.pop(key, None)
+        self._entries[key] = (data, mtime, time.time())
+        while len(self._entries) > self.max_items:
+            self._entries.popitem(last=False)
+
+    def discard(self, key):
+        self._entries.pop(key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Codec name -> (header id byte, compressor factory taking a level, decompressor factory, default level).
+CODECS = {
+    'zlib': (b'\x01', zlib.compressobj, zlib.decompressobj, 6),
+    'bz2': (b'\x02', bz2.BZ2Compressor, bz2.BZ2Decompressor, 9),
+}
+if lzma is not None:
+    CODECS['lzma'] = (b'\x03', lambda level: lzma.LZMACompressor(preset=level), lzma.LZMADecompressor, 6)
+CODEC_MAGIC = b'PYSC'  # Followed by the codec id byte. Pickle protocol 2 files start with b'\x80' instead.
+_CHUNK_SIZE = 1 << 16
+
+
+class _CompressedWriter(object):
+    """Write-only file-like object, compressing everything into f. close() must be called."""
+
+    def __init__(self, f, compressor):
+        self.f = f
+        self.compressor = compressor
+
+    def write(self, data):
+        self.f.write(self.compressor.compress(data))
+
+    def close(self):
+        self.f.write(self.compressor.flush())
+
+
+class _DecompressedReader(object):
+    """Read-only file-like object with just enough methods for cPickle.load().
+
+    Decompresses f in chunks as data is needed, so the compressed blob is never held in memory in full.
+    Decompressed chunks are kept in a list and joined once per read(), so large reads stay linear.
+    """
+
+    def __init__(self, f, decompressor):
+        self.f = f
+        self.decompressor = decompressor
+        self.pieces = collections.deque()
+        self.pos = 0  # Offset of unread data in self.pieces[0].
+        self.available = 0  # Unread bytes in all pieces.
+        self.eof = False
+
+    def _fill(self):
+        chunk = self.f.read(_CHUNK_SIZE)
+        if chunk:
+            data = self.decompressor.decompress(chunk)
+        else:
+            self.eof = True
+            data = self.decompressor.flush() if hasattr(self.decompressor, 'flush') else b''
+        if data:
+            self.pieces.append(data)
+            self.available += len(data)
+
+    def read(self, n=-1):
+        while not self.eof and (n < 0 or self.available < n):
+            self._fill()
+        if n < 0 or n > self.available:
+            n = self.available
+        parts = []
+        needed = n
+        while needed:
+            piece = self.pieces[0]
+            take = min(needed, len(piece) - self.pos)
+            parts.append(piece[self.pos:self.pos + take] if take < len(piece) else piece)
+            needed -= take
+            self.pos += take
+            if self.pos == len(piece):
+                self.pieces.popleft()
+                self.pos = 0
+        self.available -= n
+        return parts[0] if len(parts) == 1 else b''.join(parts)
+
+    def readline(self):
+        while True:
+            if self.pieces:
+                newline = self.pieces[0].find(b'\n', self.pos)
+                if newline >= 0:
+                    return self.read(newline + 1 - self.pos)
+                if len(self.pieces) > 1:
+                    # Lines are short, merging the first two pieces until one has a newline is cheap.
+                    first = self.pieces.popleft()[self.pos:]
+                    self.pieces[0] = first + self.pieces[0]
+                    self.pos = 0
+                    continue
+            if self.eof:
+                return self.read()
+            self._fill()
+
+
+class PickleStorage(object):
+    """Stores each entry as a single pickle file, optionally compressed with one of CODECS.
+
+    Compressed files start with a short header naming the codec, so any PickleStorage can read them.
+    """
+
+    suffix = '.pickle'
+
+    def __init__(self, codec=None, level=None):
+        if codec is not None and codec not in CODECS:
+            raise ValueError('Unknown codec {0!r}, expected one of {1}.'.format(codec, sorted(CODECS)))
+        self.codec = codec
+        self.level = level
+
+    def dump(self, data, path):
+        """Writes data to path, returns the number of bytes written."""
+        with open(path, 'wb') as f:
+            if self.codec is None:
+                cPickle.dump(data, f, -1)
+            else:
+                codec_id, compressor, decompressor, default_level = CODECS[self.codec]
+                f.write(CODEC_MAGIC + codec_id)
+                writer = _CompressedWriter(f, compressor(default_level if self.level is None else self.level))
+                cPickle.dump(data, writer, -1)
+                writer.close()
+            return f.tell()
 
-def cached(project, key_format):
+    def load(self, path):
+        """Returns data and the number of bytes read. Raises IOError if missing."""
+        with open(path, 'rb') as f:
+            header = f.read(len(CODEC_MAGIC) + 1)
+            if header[:len(CODEC_MAGIC)] != CODEC_MAGIC:
+                f.seek(0)
+                return cPickle.load(f), f.tell()
+            for name, (codec_id, compressor, decompressor, default_level) in CODECS.iteritems():
+                if header[-1:] == codec_id:
+                    return cPickle.load(_DecompressedReader(f, decompressor())), f.tell()
+            raise IOError('Unsupported codec in {0}, lzma may not be installed.'.format(path))
+
+
+def benchmark_codecs(data, codecs=None, repeat=3):
+    """Compares codecs on a sample cache entry. Returns rows for pyshort.strings.tabulate().
+
+    codecs is a list of (codec, level) pairs, by default no compression and each codec at its default level.
+    Each row has codec, level, size in bytes, compression ratio, best dump seconds and best load seconds.
+    """
+    if codecs is None:
+        codecs = [(None, None)] + [(name, CODECS[name][3]) for name in sorted(CODECS)]
+    dirname = tempfile.mkdtemp()
+    try:
+        path = os.path.join(dirname, 'benchmark.pickle')
+        rows = [('codec', 'level', 'bytes', 'ratio', 'dump s', 'load s')]
+        raw_size = None
+        for codec, level in codecs:
+            storage = PickleStorage(codec, level)
+            dump_times, load_times = [], []
+            for i in xrange(repeat):
+                start = time.time()
+                size = storage.dump(data, path)
+                dump_times.append(time.time() - start)
+                start = time.time()
+                storage.load(path)
+                load_times.append(time.time() - start)
+            if raw_size is None:
+                raw_size = len(cPickle.dumps(data, -1))
+            rows.append((codec or 'none', '' if level is None else level, size,
+                         '{0:.2f}'.format(raw_size / size), '{0:.4f}'.format(min(dump_times)), '{0:.4f}'.format(min(load_times))))
+        return rows
+    finally:
+        shutil.rmtree(dirname)
+
+
+class _ArrayRef(object):
+    """Placeholder for the i-th array of a NumpyStorage entry, in its pickled skeleton."""
+
+    def __init__(self, i):
+        self.i = i
+
+
+class NumpyStorage(object):
+    """Stores each entry as a directory of .npy files, loaded as read-only memory maps.
+
+    Arrays anywhere inside nested dicts, lists and tuples are written to their own .npy file.
+    Everything else goes into a small pickle sidecar: the nesting, arrays with Python objects in their dtype, and
+    ndarray subclasses (like masked arrays, which np.save can not write, or np.matrix, which would come back as a
+    plain array).
+    A hit only unpickles the sidecar and maps the arrays, data pages are read from disk when touched.
+    The returned arrays are np.memmap instances opened with mode 'r', they can not be modified.
+    """
+
+    suffix = '.npcache'
+    META_FILENAME = 'meta.pickle'
+
+    def __init__(self, codec=None, level=None):
+        if codec is not None:
+            raise ValueError('Compression codecs can not be used with memory-mapped numpy storage.')
+
+    def dump(self, data, path):
+        os.mkdir(path)
+        arrays = []
+        skeleton = self._extract(data, arrays)
+        for i, arr in enumerate(arrays):
+            np.save(os.path.join(path, '{0}.npy'.format(i)), arr)
+        with open(os.path.join(path, self.META_FILENAME), 'wb') as f:
+            cPickle.dump(skeleton, f, -1)
+        return _entry_size(path)
+
+    def load(self, path):
+        with open(os.path.join(path, self.META_FILENAME), 'rb') as f:
+            skeleton = cPickle.load(f)
+            nbytes = f.tell()
+        return self._restore(skeleton, path), nbytes
+
+    def _extract(self, obj, arrays):
+        if type(obj) in (np.ndarray, np.memmap) and not obj.dtype.hasobject:
+            arrays.append(obj)
+            return _ArrayRef(len(arrays) - 1)
+        elif type(obj) in (dict, collections.OrderedDict):  # Not subclasses with different constructors.
+            return type(obj)((k, self._extract(v, arrays)) for k, v in obj.iteritems())
+        elif type(obj) in (list, tuple):  # Not namedtuples.
+            return type(obj)(self._extract(v, arrays) for v in obj)
+        else:
+            return obj
+
+    def _restore(self, obj, path):
+        if isinstance(obj, _ArrayRef):
+            return np.load(os.path.join(path, '{0}.npy'.format(obj.i)), mmap_mode='r')
+        elif type(obj) in (dict, collections.OrderedDict):
+            return type(obj)((k, self._restore(v, path)) for k, v in obj.iteritems())
+        elif type(obj) in (list, tuple):
+            return type(obj)(self._restore(v, path) for v in obj)
+        else:
+            return obj
+
+
+STORAGES = {
+    'pickle': PickleStorage,
+    'numpy': NumpyStorage,
+}
+
+
+def _entry_size(path):
+    """Size in bytes of an entry file, or the sum of files in an entry directory."""
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, fname)) for fname in os.listdir(path))
+    return os.path.getsize(path)
+
+
+# Lock file path -> [threading.Lock, number of threads using it]. Guarded by _THREAD_LOCKS_GUARD.
+_THREAD_LOCKS = {}
+_THREAD_LOCKS_GUARD = threading.Lock()
+
+
+@contextlib.contextmanager
+def _file_lock(path):
+    """Exclusive lock across threads (threading.Lock) and processes (flock on path)."""
+    with _THREAD_LOCKS_GUARD:
+        entry = _THREAD_LOCKS.setdefault(path, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            with open(path, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+    finally:
+        with _THREAD_LOCKS_GUARD:
+            entry[1] -= 1
+            if not entry[1]:
+                del _THREAD_LOCKS[path]
+
+
+def _remove_entry(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+class DiskCache(object):
+    """Cache entries in CACHES_BASE/<project>, with an optional size and entry budget.
+
+    storage is 'pickle' (one pickle file per entry) or 'numpy' (memory-mapped arrays, see NumpyStorage).
+    codec and level compress pickle storage, see PickleStorage and benchmark_codecs().
+
+    A small index file maps each entry filename to its size in bytes and last access time.
+    Stores, hits and evictions only append a line to an index log, which is merged into the index file when it grows
+    past 1 MiB. Each DiskCache keeps the index in memory and only reads new log lines.
+    When a new entry pushes the project over max_bytes or max_entries, least recently used entries are deleted.
+    If the index is missing (for example, an old cache directory), it is rebuilt from the files on disk.
+
+    If memory is a MemoryCache, hits are served from it without unpickling. Such hits do not update the access time
+    in the index, and return the same object every time, so callers must not modify it.
+    """
+
+    def __init__(self, project, max_bytes=None, max_entries=None, memory=None, storage='pickle', codec=None, level=None,
+                 base=None):
+        self.project = project
+        self.dirname = os.path.join(base or CACHES_BASE, project)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.memory = memory
+        self.storage = STORAGES[storage](codec=codec, level=level)
+        self.stats = CacheStats()
+        # In-memory copy of the index, valid while the index file has self._index_ident, plus the log up to
+        # self._log_offset. Only used with the index lock held.
+        self._index = None
+        self._index_ident = None
+        self._index_bytes = 0
+        self._index_heap = []  # (atime, filename), including stale items that no longer match self._index.
+        self._log_offset = 0
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def path(self, key):
+        return os.path.join(self.dirname, key + self.storage.suffix)
+
+    def load(self, key):
+        """Returns the cached data for key. Raises KeyError if there is no entry."""
+        try:
+            return self._load(key)
+        except KeyError:
+            self.stats.misses += 1
+            raise
+
+    def get_or_compute(self, key, compute):
+        """Returns the cached data for key, or calls compute() and stores its result.
+
+        Single-flight: while one thread or process computes a key, others asking for it wait for the
+        result instead of computing it again. Uses a per-key lock file, so it works across processes on one host.
+        """
+        try:
+            return self._load(key)
+        except KeyError:
+            pass
+        self._makedirs()
+        with self.lock(key):
+            try:
+                return self._load(key)  # Computed by someone else while we waited.
+            except KeyError:
+                self.stats.misses += 1
+            data = compute()
+            self.store(key, data)
+            return data
+
+    def store(self, key, data):
+        """Writes data for key, then evicts least recently used entries if over budget.
+
+        The entry is written to a temporary name and renamed into place, so readers never see a partial entry.
+        """
+        self._makedirs()
+        path = self.path(key)
+        tmp_path = '{0}.{1}.{2}.tmp'.format(path, os.getpid(), thread.get_ident())
+        try:
+            nbytes = self.storage.dump(data, tmp_path)
+        except:
+            if os.path.lexists(tmp_path):
+                _remove_entry(tmp_path)
+            raise
+        if os.path.isdir(tmp_path) and os.path.exists(path):
+            # Directories can't be atomically replaced. Readers in between will wait on the key lock.
+            old_path = tmp_path + '.old'
+            os.rename(path, old_path)
+            os.rename(tmp_path, path)
+            _remove_entry(old_path)
+        else:
+            os.rename(tmp_path, path)
+        self.stats.bytes_written += nbytes
+        if self.memory is not None:
+            self.memory.put(key, data, os.stat(path).st_mtime)
+        fname = os.path.basename(path)
+        with self._index_lock():
+            self._sync_index()
+            now = time.time()
+            log_size = self._append_log('S {0} {1!r} {2}\n'.format(nbytes, now, fname))
+            self._set_entry(fname, nbytes, now)
+            if self._over_budget():
+                self._evict(keep=fname)
+            if log_size > _INDEX_LOG_COMPACT_BYTES:
+                self._compact_index()
+
+    @contextlib.contextmanager
+    def lock(self, key):
+        """Exclusive lock on key, for threads in this process and for other processes."""
+        with _file_lock(self.path(key) + '.lock'):
+            yield
+
+    def _makedirs(self):
+        # Only created when first needed, so that decorating a function at import time touches no files.
+        if not os.path.exists(self.dirname):
+            try:
+                os.makedirs(self.dirname, 0755)
+            except OSError:
+                if not os.path.isdir(self.dirname):  # Not just created by another process.
+                    raise
+
+    def _index_lock(self):
+        return _file_lock(os.path.join(self.dirname, INDEX_FILENAME + '.lock'))
+
+    def _load(self, key):
+        path = self.path(key)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            if self.memory is not None:
+                self.memory.discard(key)
+            raise KeyError(key)
+        if self.memory is not None:
+            try:
+                data = self.memory.get(key, mtime)
+                self.stats.hits += 1
+                self.stats.memory_hits += 1
+                return data
+            except KeyError:
+                pass
+        try:
+            data, nbytes = self.storage.load(path)
+        except IOError:
+            raise KeyError(key)  # Evicted or replaced since the stat.
+        self.stats.hits += 1
+        self.stats.bytes_read += nbytes
+        if self.memory is not None:
+            self.memory.put(key, data, mtime)
+        # Without the index lock. An access line for an entry evicted meanwhile is ignored when the log is read.
+        try:
+            log_size = self._append_log('A {0!r} {1}\n'.format(time.time(), os.path.basename(path)))
+        except OSError:
+            return data  # Project directory removed meanwhile, the loaded data is still valid.
+        if log_size > _INDEX_LOG_COMPACT_BYTES:
+            with self._index_lock():
+                self._sync_index()
+                self._compact_index()
+        return data
+
+    def _over_budget(self):
+        if self.max_entries is not None and len(self._index) > self.max_entries:
+            return True
+        if self.max_bytes is not None and self._index_bytes > self.max_bytes:
+            return True
+        return False
+
+    def _set_entry(self, fname, nbytes, atime):
+        old_size, old_atime = self._index.get(fname, (0, 0))
+        self._index[fname] = (nbytes, atime)
+        self._index_bytes += nbytes - old_size
+        self._push_heap(fname, atime)
+
+    def _push_heap(self, fname, atime):
+        heapq.heappush(self._index_heap, (atime, fname))
+        if len(self._index_heap) > 2 * len(self._index) + 1000:
+            self._rebuild_heap()
+
+    def _rebuild_heap(self):
+        self._index_heap = [(atime, fname) for fname, (size, atime) in self._index.iteritems()]
+        heapq.heapify(self._index_heap)
+
+    def _evict(self, keep):
+        # Oldest access first. The entry just written is never evicted, even if it alone is over budget.
+        index = self._index
+        heap = self._index_heap
+        kept = None
+        while heap and self._over_budget():
+            atime, fname = heapq.heappop(heap)
+            if fname not in index or index[fname][1] != atime:
+                continue  # Stale, the entry was accessed again or removed.
+            if fname == keep:
+                kept = (atime, fname)
+                continue
+            self._index_bytes -= index.pop(fname)[0]
+            self._append_log('D {0}\n'.format(fname))
+            if self.memory is not None:
+                self.memory.discard(os.path.splitext(fname)[0])
+            try:
+                _remove_entry(os.path.join(self.dirname, fname))
+            except OSError:
+                pass  # Already deleted by hand.
+            try:
+                os.remove(os.path.join(self.dirname, fname + '.lock'))
+            except OSError:
+                pass
+            self.stats.evictions += 1
+        if kept is not None:
+            heapq.heappush(heap, kept)
+
+    def _append_log(self, line):
+        """Appends one line to the index log, returns the log size. Short O_APPEND writes do not interleave."""
+        fd = os.open(os.path.join(self.dirname, INDEX_LOG_FILENAME), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        try:
+            os.write(fd, line.encode('utf-8'))
+            return os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+
+    def _sync_index(self):
+        """Brings the in-memory index up to date with the index file and new log lines. Needs the index lock."""
+        index_path = os.path.join(self.dirname, INDEX_FILENAME)
+        log_path = os.path.join(self.dirname, INDEX_LOG_FILENAME)
+        ident = self._stat_ident(index_path)
+        try:
+            log_size = os.path.getsize(log_path)
+        except OSError:
+            log_size = 0
+        if self._index is None or ident is None or ident != self._index_ident or log_size < self._log_offset:
+            # Compacted by another process, or never loaded.
+            self._index = self._read_index()
+            self._index_bytes = sum(size for size, atime in self._index.itervalues())
+            self._rebuild_heap()
+            self._log_offset = 0
+            if ident is None:
+                self._compact_index()
+                return
+            self._index_ident = ident
+        if log_size == self._log_offset:
+            return
+        with open(log_path, 'rb') as f:
+            f.seek(self._log_offset)
+            data = f.read()
+        end = data.rfind(b'\n') + 1  # A line still being appended is read next time.
+        self._log_offset += end
+        for line in data[:end].decode('utf-8').splitlines():
+            if line.startswith('S '):
+                kind, nbytes, atime, fname = line.split(' ', 3)
+                self._set_entry(fname, int(nbytes), float(atime))
+            elif line.startswith('D '):
+                self._index_bytes -= self._index.pop(line[2:], (0, 0))[0]
+            elif line.startswith('A '):
+                kind, atime, fname = line.split(' ', 2)
+                if fname in self._index and float(atime) > self._index[fname][1]:
+                    self._index[fname] = (self._index[fname][0], float(atime))
+                    self._push_heap(fname, float(atime))
+
+    def _compact_index(self):
+        """Writes the in-memory index to the index file and empties the log. Needs the index lock.
+
+        Access lines appended by hits while this runs may be lost, which only makes the LRU order less exact.
+        """
+        self._write_index(self._index)
+        with open(os.path.join(self.dirname, INDEX_LOG_FILENAME), 'wb'):
+            pass
+        self._index_ident = self._stat_ident(os.path.join(self.dirname, INDEX_FILENAME))
+        self._log_offset = 0
+
+    @staticmethod
+    def _stat_ident(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime, st.st_size
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.dirname, INDEX_FILENAME), 'rb') as f:
+                return cPickle.load(f)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return self._scan_index()
+
+    def _scan_index(self):
+        index = {}
+        suffixes = tuple(storage.suffix for storage in STORAGES.itervalues())
+        for fname in os.listdir(self.dirname):
+            if fname.endswith(suffixes) and fname != INDEX_FILENAME:
+                path = os.path.join(self.dirname, fname)
+                index[fname] = (_entry_size(path), os.stat(path).st_mtime)
+        return index
+
+    def _write_index(self, index):
+        path = os.path.join(self.dirname, INDEX_FILENAME)
+        tmp_path = '{0}.{1}.{2}.tmp'.format(path, os.getpid(), thread.get_ident())
+        with open(tmp_path, 'wb') as f:
+            cPickle.dump(index, f, -1)
+        os.rename(tmp_path, path)
+
+
+def cached(project, key_format=None, max_bytes=None, max_entries=None, memory_items=0, memory_ttl=None, storage='pickle',
+           codec=None, level=None):
     """Caching decorator for slow functions.
 
     Usage:
-    @cached(project name (used as directory), key format string (used as filename))
+    @cached(project name (used as directory), optional key format string (used as filename prefix))
     def slow(...):
         pass
 
+    Entries are keyed by a hash of the function module, name and all arguments, see cache_key().
     Key format string can include positional args with {0} and keyword args {name} from the function call.
-    A special keyword arg func_name is added to the formatting parameters.
+    A special keyword arg func_name is added to the formatting parameters. The formatted key only makes
+    filenames readable, the hash is always appended.
+
+    max_bytes and max_entries limit the size of the project directory, evicting least recently used entries.
+    memory_items > 0 keeps that many loaded results in an in-process LRU, optionally expiring after memory_ttl seconds.
+    codec is None, 'zlib', 'bz2' or 'lzma' (if available) to compress pickles, at the given level or codec default.
+    storage='numpy' stores NumPy arrays in the result as memory-mapped .npy files, see NumpyStorage.
+    Concurrent calls with the same arguments, from threads or processes on one host, run the function only once.
+    The decorated function has a .cache attribute with the DiskCache, and its counters in .cache.stats.
+    It also has a .warm(arg_tuples, workers=N) method to fill the cache for many inputs in parallel.
     """
+    memory = MemoryCache(memory_items, ttl=memory_ttl) if memory_items > 0 else None
+    store = DiskCache(project, max_bytes=max_bytes, max_entries=max_entries, memory=memory, storage=storage,
+                      codec=codec, level=level)
+
+    def make_key(func, args, kwargs):
+        key = cache_key(func, args, kwargs)
+        if key_format is not None:
+            key = key_format.format(*args, **dict(kwargs, func_name=func.__name__)) + '-' + key
+        return key
+
     def caching(func, *args, **kwargs):
-        key = key_format.format(*args, **dict(kwargs, func_name=func.__name__))
-        dirname = os.path.join(CACHES_BASE, project)
-        if not os.path.exists(dirname):
-            os.mkdir(dirname, 0755)
-        filename = os.path.join(dirname, key + '.pickle')
-        try:
-            with open(filename, 'rb') as f:
-                return cPickle.load(f)
-        except IOError:
+        key = make_key(func, args, kwargs)
+
+        def compute():
             print('No cache for {0}/{1}, running slow function.'.format(project, key), file=sys.stderr)
-            data = func(*args, **kwargs)
-            with open(filename, 'wb') as f:
-                cPickle.dump(data, f, -1)
-            return data
-    return decorator(caching)
+            return func(*args, **kwargs)
+        return store.get_or_compute(key, compute)
+
+    def decorate(func):
+        wrapped = decorator(caching, func)
+
+        def warm(arg_tuples, workers=1):
+            """Fills the cache for each tuple of positional arguments, computing only missing entries.
+
+            With workers > 1, missing entries are computed in a multiprocessing.Pool. Workers call the decorated
+            function, so results are written through the normal storage path and are not sent back.
+            The decorated function must then be importable by name (defined at module level).
+            Prints progress to stderr, and returns the number of entries computed.
+            """
+            missing = collections.OrderedDict()
+            count = 0  # arg_tuples may be a generator, so count while iterating.
+            for args in arg_tuples:
+                count += 1
+                args = tuple(args)
+                key = make_key(func, args, {})
+                if key not in store:
+                    missing[key] = args
+            total = len(missing)
+            print('Warming {0}/{1}: {2} of {3} entries missing.'.format(project, func.__name__, total, count),
+                  file=sys.stderr)
+            if workers > 1 and total > 1:
+                pool = multiprocessing.Pool(min(workers, total))
+                try:
+                    done = pool.imap_unordered(_warm_call, [(wrapped, args) for args in missing.itervalues()])
+                    for i, _ in enumerate(done):
+                        print('Warming {0}/{1}: {2}/{3} done.'.format(project, func.__name__, i + 1, total), file=sys.stderr)
+                    pool.close()
+                finally:
+                    pool.terminate()
+                    pool.join()
+            else:
+                for i, args in enumerate(missing.itervalues()):
+                    wrapped(*args)
+                    print('Warming {0}/{1}: {2}/{3} done.'.format(project, func.__name__, i + 1, total), file=sys.stderr)
+            return total
+
+        wrapped.cache = store
+        wrapped.warm = warm
+        return wrapped
+    return decorate
+
+
+def _warm_call(func_args):
+    """Pool worker for warm(). Module level, so that it can be pickled."""
+    func, args = func_args
+    func(*args)
+
+
+@cached('warm-test')
+def _warm_test_square(x):
+    """Module level, so that warm() can run it in pool workers."""
+    return x * x
+
+
+class DiskCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.base)
+
+    def test_key_binds_arguments(self):
+        def f(a, b=2):
+            pass
+        self.assertEqual(cache_key(f, (1,), {}), cache_key(f, (1,), {'b': 2}))
+        self.assertEqual(cache_key(f, (1, 2), {}), cache_key(f, (), {'a': 1, 'b': 2}))
+        self.assertNotEqual(cache_key(f, (1,), {}), cache_key(f, (2,), {}))
+
+    def test_hit_and_miss(self):
+        store = DiskCache('p', base=self.base)
+        self.assertRaises(KeyError, store.load, 'a')
+        store.store('a', [1, 2, 3])
+        self.assertEqual([1, 2, 3], store.load('a'))
+        self.assertEqual(1, store.stats.hits)
+        self.assertEqual(1, store.stats.misses)
+        self.assertEqual(store.stats.bytes_read, store.stats.bytes_written)
+
+    def test_evict_entries_lru(self):
+        store = DiskCache('p', max_entries=2, base=self.base)
+        store.store('a', 1)
+        store.store('b', 2)
+        store.load('a')  # b is now least recently used.
+        store.store('c', 3)
+        self.assertEqual(1, store.stats.evictions)
+        self.assertEqual(1, store.load('a'))
+        self.assertRaises(KeyError, store.load, 'b')
+
+    def test_evict_bytes(self):
+        store = DiskCache('p', max_bytes=1500, base=self.base)
+        store.store('a', 'x' * 1000)
+        store.store('b', 'y' * 1000)
+        self.assertRaises(KeyError, store.load, 'a')
+        self.assertEqual('y' * 1000, store.load('b'))
+
+    def test_rebuild_index(self):
+        store = DiskCache('p', base=self.base)
+        store.store('a', 1)
+        os.remove(os.path.join(store.dirname, INDEX_FILENAME))
+        self.assertEqual(['a.pickle'], list(store._read_index()))
+
+    def test_index_log_shared(self):
+        store = DiskCache('p', max_entries=2, base=self.base)
+        other = DiskCache('p', base=self.base)  # Another process.
+        store.store('a', 1)
+        store.store('b', 2)
+        other.store('x', 0)  # Over store's budget, but not other's.
+        other.load('a')  # Only logged, b and x are now least recently used.
+        store.store('c', 3)
+        self.assertEqual(2, store.stats.evictions)
+        self.assertEqual(['a.pickle', 'c.pickle'], sorted(store._index))
+        self.assertEqual(2, store._index_bytes // os.path.getsize(store.path('c')))
+        self.assertFalse(os.path.exists(store.path('b')))
+
+    def test_evicted_during_load(self):
+        store = DiskCache('p', base=self.base)
+        other = DiskCache('p', max_entries=1, base=self.base)  # Another process.
+        store.store('a', 1)
+        load = store.storage.load
+
+        def load_then_evict(path):
+            result = load(path)
+            other.store('b', 2)
+            return result
+        store.storage.load = load_then_evict
+        self.assertEqual(1, store.load('a'))
+        self.assertFalse(os.path.exists(store.path('a')))
+        store.storage.load = load
+        store.store('c', 3)
+        self.assertEqual(['b.pickle', 'c.pickle'], sorted(store._index))  # a is not added back.
+
+    def test_index_log_compaction(self):
+        global _INDEX_LOG_COMPACT_BYTES
+        old_size, _INDEX_LOG_COMPACT_BYTES = _INDEX_LOG_COMPACT_BYTES, 0
+        try:
+            store = DiskCache('p', max_entries=2, base=self.base)
+            store.store('a', 1)
+            store.store('b', 2)
+            store.load('a')
+            self.assertEqual(0, os.path.getsize(os.path.join(store.dirname, INDEX_LOG_FILENAME)))
+            other = DiskCache('p', max_entries=2, base=self.base)
+            other.store('c', 3)
+            self.assertEqual(['a.pickle', 'c.pickle'], sorted(other._read_index()))
+            store.store('d', 4)  # Reloads the index compacted by other.
+            self.assertEqual(['c.pickle', 'd.pickle'], sorted(store._index))
+        finally:
+            _INDEX_LOG_COMPACT_BYTES = old_size
+
+    def test_memory_hit(self):
+        store = DiskCache('p', memory=MemoryCache(10), base=self.base)
+        store.store('a', [1])
+        first = store.load('a')
+        self.assertIs(first, store.load('a'))
+        self.assertEqual(2, store.stats.memory_hits)
+        self.assertEqual(0, store.stats.bytes_read)
+
+    def test_memory_invalidated_by_rewrite(self):
+        store = DiskCache('p', memory=MemoryCache(10), base=self.base)
+        store.store('a', [1])
+        other = DiskCache('p', base=self.base)  # Another process.
+        other.store('a', [2])
+        os.utime(other.path('a'), (0, 0))  # mtime resolution may be coarser than this test.
+        self.assertEqual([2], store.load('a'))
+
+    def test_memory_lru_and_ttl(self):
+        memory = MemoryCache(2)
+        memory.put('a', 1, 0)
+        memory.put('b', 2, 0)
+        memory.get('a', 0)
+        memory.put('c', 3, 0)
+        self.assertRaises(KeyError, memory.get, 'b', 0)
+        self.assertEqual(1, memory.get('a', 0))
+        memory = MemoryCache(2, ttl=-1)
+        memory.put('a', 1, 0)
+        self.assertRaises(KeyError, memory.get, 'a', 0)
+
+    def test_numpy_storage(self):
+        store = DiskCache('p', storage='numpy', base=self.base)
+        data = {'x': np.arange(10), 'y': [np.ones((2, 3)), 'label'], 'z': np.array([None]),
+                'w': np.array([(1, None)], dtype=[(b'a', int), (b'b', object)])}
+        store.store('a', data)
+        loaded = store.load('a')
+        self.assertIsInstance(loaded['x'], np.memmap)
+        self.assertTrue(np.array_equal(data['x'], loaded['x']))
+        self.assertTrue(np.array_equal(data['y'][0], loaded['y'][0]))
+        self.assertEqual('label', loaded['y'][1])
+        self.assertNotIsInstance(loaded['z'], np.memmap)
+        self.assertNotIsInstance(loaded['w'], np.memmap)  # Object field, can't be memory-mapped.
+        self.assertEqual([(1, None)], loaded['w'].tolist())
+        self.assertFalse(loaded['x'].flags.writeable)
+
+    def test_numpy_storage_subclasses(self):
+        store = DiskCache('p', storage='numpy', base=self.base)
+        store.store('a', {'masked': np.ma.masked_array([1, 2, 3], mask=[0, 1, 0]), 'matrix': np.matrix([[1, 2]])})
+        loaded = store.load('a')
+        self.assertIsInstance(loaded['masked'], np.ma.MaskedArray)
+        self.assertEqual([1, None, 3], loaded['masked'].tolist())
+        self.assertIsInstance(loaded['matrix'], np.matrix)
+        store.store('b', np.arange(3))
+        store.store('c', {'memmap': store.load('b')})  # Memory maps from a hit are stored as .npy again.
+        self.assertTrue(os.path.exists(os.path.join(store.path('c'), '0.npy')))
+
+    def test_numpy_storage_evict(self):
+        store = DiskCache('p', max_entries=1, storage='numpy', base=self.base)
+        store.store('a', np.arange(10))
+        store.store('b', np.arange(10))
+        self.assertFalse(os.path.exists(store.path('a')))
+        self.assertEqual(1, store.stats.evictions)
+
+    def test_single_flight_threads(self):
+        store = DiskCache('p', base=self.base)
+        calls = []
+        def compute():
+            calls.append(1)
+            time.sleep(0.05)
+            return 42
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(store.get_or_compute('a', compute)))
+                   for i in xrange(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([42] * 8, results)
+        self.assertEqual(1, len(calls))
+        self.assertEqual(1, store.stats.misses)
+
+    def test_no_temporary_files_left(self):
+        store = DiskCache('p', storage='numpy', base=self.base)
+        store.store('a', np.arange(3))
+        store.store('a', np.arange(4))
+        self.assertEqual(4, len(store.load('a')))
+        self.assertFalse([fname for fname in os.listdir(store.dirname) if 'tmp' in fname])
+
+    def test_no_temporary_files_left_on_error(self):
+        for storage in STORAGES:
+            store = DiskCache(storage, storage=storage, base=self.base)
+            self.assertRaises(Exception, store.store, 'a', {'x': np.arange(3), 'f': lambda: 1})  # Not picklable.
+            self.assertEqual([], [fname for fname in os.listdir(store.dirname) if 'tmp' in fname])
+            self.assertNotIn('a', store)
+
+    def test_codecs(self):
+        data = {'text': 'abc\n' * 10000, 'numbers': range(1000)}
+        plain = DiskCache('plain', base=self.base)
+        plain.store('a', data)
+        for codec in CODECS:
+            store = DiskCache(codec, codec=codec, level=1, base=self.base)
+            store.store('a', data)
+            self.assertEqual(data, store.load('a'))
+            self.assertEqual(data, DiskCache(codec, base=self.base).load('a'))  # Codec detected from header.
+            self.assertLess(store.stats.bytes_written, plain.stats.bytes_written)
+
+    def test_codec_large_entry(self):
+        data = os.urandom(4 << 20)  # Incompressible, so decompressed chunks are small and many.
+        store = DiskCache('p', codec='zlib', level=1, base=self.base)
+        store.store('a', data)
+        self.assertEqual(data, store.load('a'))
+
+    def test_decompressed_reader_linear(self):
+        class CountingDecompressor(object):
+            """Passes chunks through unchanged, remembering them."""
+            def __init__(self):
+                self.outputs = []
+
+            def decompress(self, chunk):
+                self.outputs.append(chunk)
+                return chunk
+        data = b''.join(bytes(bytearray([i])) * _CHUNK_SIZE for i in xrange(100))
+        decompressor = CountingDecompressor()
+        reader = _DecompressedReader(cStringIO.StringIO(data), decompressor)
+        self.assertEqual(data[:10], reader.read(10))
+        self.assertEqual(1, len(decompressor.outputs))
+        # One large read, like cPickle does for a big string, decompresses each chunk once.
+        self.assertEqual(data[10:-_CHUNK_SIZE], reader.read(len(data) - _CHUNK_SIZE - 10))
+        self.assertEqual(99, len(decompressor.outputs))
+        self.assertEqual(0, len(reader.pieces))  # Nothing left over to copy again.
+        # A read of exactly one decompressed chunk returns it without copying.
+        last = reader.read(_CHUNK_SIZE)
+        self.assertIs(decompressor.outputs[99], last)
+        self.assertEqual(b'', reader.read())
+
+    def test_decompressed_reader(self):
+        reader = _DecompressedReader(cStringIO.StringIO(zlib.compress(b'ab\ncd\n\nxyz')), zlib.decompressobj())
+        self.assertEqual([b'ab\n', b'c', b'd\n', b'\n', b'xy', b'z', b'', b''],
+                         [reader.readline(), reader.read(1), reader.readline(), reader.readline(), reader.read(2),
+                          reader.read(), reader.read(), reader.readline()])
+        text_pickle = zlib.compress(cPickle.dumps({'a': [1.5, 'b' * 100000]}, 0))  # Protocol 0 uses readline().
+        reader = _DecompressedReader(cStringIO.StringIO(text_pickle), zlib.decompressobj())
+        self.assertEqual({'a': [1.5, 'b' * 100000]}, cPickle.load(reader))
+
+    def test_unknown_codec(self):
+        self.assertRaises(ValueError, DiskCache, 'p', codec='zip', base=self.base)
+        self.assertRaises(ValueError, DiskCache, 'p', codec='zlib', storage='numpy', base=self.base)
+
+    def test_benchmark_codecs(self):
+        rows = benchmark_codecs(range(1000), repeat=1)
+        self.assertEqual(len(CODECS) + 2, len(rows))
+
+    def test_decorator(self):
+        global CACHES_BASE
+        old_base, CACHES_BASE = CACHES_BASE, self.base
+        try:
+            calls = []
+            @cached('p', key_format='{func_name}')
+            def slow(a, b=2):
+                calls.append(a)
+                return a + b
+            self.assertEqual(3, slow(1))
+            self.assertEqual(3, slow(1, b=2))
+            self.assertEqual(4, slow(2))
+            self.assertEqual([1, 2], calls)
+            self.assertEqual(1, slow.cache.stats.hits)
+
+            self.assertEqual(2, slow.warm([(1,), (3,), (4,), (4,)]))
+            self.assertEqual([1, 2, 3, 4], calls)
+            self.assertEqual(0, slow.warm([(1,), (3,)], workers=4))
+        finally:
+            CACHES_BASE = old_base
+
+    def test_warm_pool(self):
+        store = _warm_test_square.cache
+        old_dirname, store.dirname = store.dirname, os.path.join(self.base, 'warm-test')
+        try:
+            self.assertEqual(3, _warm_test_square.warm(((x,) for x in [1, 2, 3, 2]), workers=2))
+            self.assertEqual(3, len(store._scan_index()))
+            misses = store.stats.misses
+            self.assertEqual(9, _warm_test_square(3))
+            self.assertEqual(misses, store.stats.misses)  # Computed by a worker process.
+            self.assertEqual(1, _warm_test_square.warm(iter([(3,), (4,)]), workers=2))
+        finally:
+            store.dirname = old_dirname
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+"""
+Sets of [start,end) intervals, backed by sorted Numpy arrays.
+Useful for combining split_nonzero() output from several channels without Python loops.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+from future_builtins import *  # ascii, filter, hex, map, oct, zip
+
+import numpy as np
+import unittest
+
+from pyshort.arrays import split_nonzero
+
+
+def _as_bounds(values):
+    """Array of interval bounds. Empty lists and tuples become int arrays, not Numpy's default float64,
+    so that combining with an empty set keeps integer bounds."""
+    if isinstance(values, np.ndarray):
+        return values
+    values = np.asarray(values)
+    return values if values.size else values.astype(int)
+
+
+class IntervalSet(object):
+    """Half-open [start,end) intervals, sorted by start and not overlapping.
+
+    Construction only merges overlapping intervals, so touching ones (like split_nonzero() sections) stay separate.
+    Set operations (union, intersection, difference) work on the covered points and return maximal intervals,
+    with touching intervals merged. Empty intervals are dropped.
+    """
+
+    def __init__(self, starts=(), ends=()):
+        starts = _as_bounds(starts)
+        ends = _as_bounds(ends)
+        assert starts.shape == ends.shape and starts.ndim == 1, 'starts and ends must be 1D arrays of equal length.'
+        assert (ends >= starts).all(), 'Intervals must not end before they start.'
+        keep = ends > starts
+        starts, ends = starts[keep], ends[keep]
+        order = np.argsort(starts, kind='mergesort')
+        starts, ends = starts[order], ends[order]
+        if len(starts) > 1:
+            # A new interval begins wherever the start is not inside any earlier interval.
+            reach = np.maximum.accumulate(ends)
+            first = np.concatenate(([True], starts[1:] >= reach[:-1]))
+            idxs, = np.nonzero(first)
+            starts, ends = starts[idxs], np.maximum.reduceat(ends, idxs)
+        self.starts = starts
+        self.ends = ends
+
+    @classmethod
+    def from_mask(cls, mask):
+        """Intervals where the boolean array is True (nonzero)."""
+        padded = np.concatenate(([0], np.asarray(mask).astype(bool).astype('int8'), [0]))
+        diff = np.diff(padded)
+        starts, = np.nonzero(diff == 1)
+        ends, = np.nonzero(diff == -1)
+        return cls(starts, ends)
+
+    @classmethod
+    def from_split_nonzero(cls, splits):
+        """Intervals from split_nonzero() output, an (n, 2) array or an empty array."""
+        splits = np.asarray(splits, dtype=int).reshape(-1, 2)
+        return cls(splits[:, 0], splits[:, 1])
+
+    @classmethod
+    def split_nonzero(cls, arr):
+        """Shortcut for IntervalSet.from_split_nonzero(split_nonzero(arr))."""
+        return cls.from_split_nonzero(split_nonzero(arr))
+
+    def to_mask(self, length):
+        """Boolean array of the given length, True inside intervals. Bounds must be integers."""
+        counts = np.zeros(length + 1, dtype=np.int32)
+        np.add.at(counts, np.clip(self.starts, 0, length).astype(int), 1)
+        np.add.at(counts, np.clip(self.ends, 0, length).astype(int), -1)
+        return np.cumsum(counts[:-1]) > 0
+
+    def to_split_nonzero(self):
+        """Intervals as an int array of [start,end) pairs, in the same format as split_nonzero()."""
+        if not len(self):
+            return np.array([], dtype=int)
+        return np.column_stack((self.starts, self.ends)).astype(int)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __eq__(self, other):
+        return np.array_equal(self.starts, other.starts) and np.array_equal(self.ends, other.ends)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'IntervalSet({0})'.format(', '.join('[{0}, {1})'.format(s, e) for s, e in zip(self.starts, self.ends)))
+
+    def lengths(self):
+        return self.ends - self.starts
+
+    def total_length(self):
+        return self.lengths().sum()
+
+    def union(self, other):
+        return self._combine(other, lambda level: level > 0)
+
+    def intersection(self, other):
+        return self._combine(other, lambda level: level == 3)
+
+    def difference(self, other):
+        return self._combine(other, lambda level: level == 1)
+
+    __or__ = union
+    __and__ = intersection
+    __sub__ = difference
+
+    def merge_gaps(self, max_gap):
+        """Merges intervals separated by at most max_gap. With max_gap=0, merges touching intervals."""
+        if not len(self):
+            return self
+        first = np.concatenate(([True], self.starts[1:] - self.ends[:-1] > max_gap))
+        idxs, = np.nonzero(first)
+        return IntervalSet(self.starts[idxs], self.ends[np.concatenate((idxs[1:] - 1, [len(self) - 1]))])
+
+    def filter_length(self, min_length):
+        """Keeps intervals with length >= min_length."""
+        keep = self.lengths() >= min_length
+        return IntervalSet(self.starts[keep], self.ends[keep])
+
+    def index_of(self, points):
+        """Returns, for each point, the index of the interval containing it, or -1."""
+        points = np.asarray(points)
+        idx = np.searchsorted(self.starts, points, side='right') - 1
+        inside = (idx >= 0) & (points < self.ends[np.maximum(idx, 0)]) if len(self) else np.zeros(points.shape, dtype=bool)
+        return np.where(inside, idx, -1)
+
+    def contains(self, points):
+        """Boolean array, True for points inside any interval."""
+        return self.index_of(points) >= 0
+
+    def _combine(self, other, select):
+        """Sweeps over all interval boundaries, keeping maximal runs where select(level) is True.
+
+        Level is 1 inside self only, 2 inside other only and 3 inside both.
+        """
+        coords = np.concatenate((self.starts, self.ends, other.starts, other.ends))
+        if not len(coords):
+            return IntervalSet()
+        deltas = np.concatenate((np.ones(len(self), dtype=np.int8), -np.ones(len(self), dtype=np.int8),
+                                 np.full(len(other), 2, dtype=np.int8), np.full(len(other), -2, dtype=np.int8)))
+        order = np.argsort(coords, kind='mergesort')
+        coords = coords[order]
+        levels = np.cumsum(deltas[order])
+        # Level after all boundaries at the same coordinate applies until the next coordinate.
+        last, = np.nonzero(np.concatenate((coords[1:] != coords[:-1], [True])))
+        coords, levels = coords[last], levels[last]
+        selected = select(levels[:-1])
+        padded = np.concatenate(([False], selected, [False])).astype('int8')
+        diff = np.diff(padded)
+        run_starts, = np.nonzero(diff == 1)
+        run_ends, = np.nonzero(diff == -1)
+        return IntervalSet(coords[run_starts], coords[run_ends])
+
+
+class IntervalSetTest(unittest.TestCase):
+    def assertIntervals(self, expected, intervals):
+        self.assertEqual([tuple(i) for i in expected], list(zip(intervals.starts.tolist(), intervals.ends.tolist())))
+
+    def test_construct(self):
+        self.assertIntervals([], IntervalSet())
+        self.assertIntervals([(0, 2), (2, 5)], IntervalSet([2, 0], [5, 2]))
+        self.assertIntervals([(0, 6), (7, 8)], IntervalSet([0, 1, 3, 7, 7], [4, 2, 6, 7, 8]))
+
+    def test_mask_round_trip(self):
+        mask = np.array([0, 1, 1, 0, 1, 0, 0, 1], dtype=bool)
+        intervals = IntervalSet.from_mask(mask)
+        self.assertIntervals([(1, 3), (4, 5), (7, 8)], intervals)
+        self.assertTrue(np.array_equal(mask, intervals.to_mask(len(mask))))
+        self.assertTrue(np.array_equal(np.zeros(3, dtype=bool), IntervalSet().to_mask(3)))
+
+    def test_split_nonzero_round_trip(self):
+        for arr in [[], [3, 4], [0, 0, 3, 0, 0, 3, 0], [0, 3, 0, 3, 3, 0]]:
+            splits = split_nonzero(np.array(arr))
+            self.assertTrue(np.array_equal(splits, IntervalSet.from_split_nonzero(splits).to_split_nonzero()))
+        self.assertIntervals([(0, 2), (2, 5), (5, 7)], IntervalSet.split_nonzero(np.array([0, 0, 3, 0, 0, 3, 0])))
+
+    def test_union(self):
+        a = IntervalSet([0, 10], [5, 15])
+        b = IntervalSet([3, 15, 20], [7, 17, 21])
+        self.assertIntervals([(0, 7), (10, 17), (20, 21)], a | b)
+        self.assertIntervals([(0, 5)], IntervalSet([0, 2], [2, 5]) | IntervalSet())
+        for empty in [IntervalSet(), IntervalSet([], []), IntervalSet.split_nonzero(np.zeros(0))]:
+            self.assertEqual(np.dtype(int), (IntervalSet([0, 2], [2, 5]) | empty).starts.dtype)
+            self.assertEqual(np.dtype(int), (empty | empty).ends.dtype)
+        self.assertEqual(np.float64, (IntervalSet([0.5], [1]) | IntervalSet()).starts.dtype)
+
+    def test_intersection(self):
+        a = IntervalSet([0, 10], [5, 15])
+        b = IntervalSet([3, 5, 12], [7, 10, 20])
+        self.assertIntervals([(3, 5), (12, 15)], a & b)
+        self.assertIntervals([], a & IntervalSet())
+
+    def test_difference(self):
+        a = IntervalSet([0, 10], [5, 15])
+        b = IntervalSet([3, 12], [4, 13])
+        self.assertIntervals([(0, 3), (4, 5), (10, 12), (13, 15)], a - b)
+        self.assertIntervals([], b - a)
+
+    def test_against_masks(self):
+        rng = np.random.RandomState(0)
+        for i in xrange(20):
+            m1 = rng.random_sample(100) < 0.5
+            m2 = rng.random_sample(100) < 0.5
+            a, b = IntervalSet.from_mask(m1), IntervalSet.from_mask(m2)
+            self.assertTrue(np.array_equal(m1 | m2, (a | b).to_mask(100)))
+            self.assertTrue(np.array_equal(m1 & m2, (a & b).to_mask(100)))
+            self.assertTrue(np.array_equal(m1 & ~m2, (a - b).to_mask(100)))
+
+    def test_merge_gaps(self):
+        intervals = IntervalSet([0, 2, 6, 20], [2, 4, 8, 21])
+        self.assertIntervals([(0, 4), (6, 8), (20, 21)], intervals.merge_gaps(0))
+        self.assertIntervals([(0, 8), (20, 21)], intervals.merge_gaps(2))
+        self.assertIntervals([], IntervalSet().merge_gaps(2))
+
+    def test_filter_length(self):
+        self.assertIntervals([(0, 3), (10, 15)], IntervalSet([0, 5, 10], [3, 6, 15]).filter_length(3))
+
+    def test_index_of(self):
+        intervals = IntervalSet([0, 10], [5, 15])
+        self.assertEqual([0, 0, -1, 1, -1, -1], list(intervals.index_of([0, 4.5, 5, 10, 15, -1])))
+        self.assertEqual([-1], list(IntervalSet().index_of([3])))
+        self.assertEqual([True, False], list(intervals.contains([3, 7])))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,27 +5,41 @@ Utilities for working with data structures and iterables.
 from __future__ import absolute_import, division, print_function, unicode_literals
 from future_builtins import *  # ascii, filter, hex, map, oct, zip
 
+import collections
+import heapq
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.pool
+import operator
+import Queue
+import random
+import sys
+import time
+import traceback
 import unittest
 
 
+logger = logging.getLogger(__name__)
+
+
 def successive(iterable, n=2):
     """Returns successive pairs or larger tuples of elements.
     With n=2: A B C D -> (A, B), (B, C), (C, D)
     With n=3: A B C D -> (A, B, C), (B, C, D)
 
     Useful for calculating deltas or "surrounding context" when iterating.
+    For Numpy arrays, arrays.sliding_windows() returns all windows as one view without copying.
     """
     iterable = iter(iterable)
-    # Prefill buffer of size n.
-    buffer = []
-    for i in xrange(n):
-        buffer.append(iterable.next())
+    # Prefill buffer of size n. Appending to a full deque drops its oldest element in O(1).
+    buffer = collections.deque(itertools.islice(iterable, n), maxlen=n)
+    if len(buffer) < n:
+        return
     # Buffer must be copied, so that caller can call list(successive()) if needed.
     # If it were returned in-place, all copies would keep changing.
     yield tuple(buffer)
-    # Rotate buffer for all new elements.
     for elem in iterable:
-        buffer.pop(0)
         buffer.append(elem)
         yield tuple(buffer)
 
@@ -55,14 +69,96 @@ def igrouper(iterable, n):
         yield inner()
 
 
+def parallel_batches(iterable, n, func, workers, ordered=True, processes=True, max_in_flight=None):
+    """Yields func(batch) for each batch (list) of n elements from iterable, computed in a worker pool.
+
+    Batches are made with igrouper() and materialized as lists, so they can be sent to workers.
+    At most max_in_flight batches (default 2 * workers) are submitted but not yet yielded, so a large or
+    infinite iterable is read only as fast as results are consumed.
+    With ordered=True, results come in batch order, otherwise as soon as they finish.
+    processes=True uses a multiprocessing.Pool (func and batches must be picklable), False a thread pool.
+
+    If func raises, the worker traceback is logged, the pool is stopped and the exception is re-raised here.
+    """
+    assert workers > 0
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+    assert max_in_flight > 0
+    pool = multiprocessing.Pool(workers) if processes else multiprocessing.pool.ThreadPool(workers)
+    batches = (batch for batch in (list(sub) for sub in igrouper(iterable, n)) if batch)
+    in_flight = collections.OrderedDict()  # Batch number -> AsyncResult, in batch order.
+    finished = Queue.Queue()  # Batch numbers, put by the pool's result thread as batches finish.
+    try:
+        exhausted = False
+        submitted = 0
+        while True:
+            while not exhausted and len(in_flight) < max_in_flight:
+                batch = next(batches, None)
+                if batch is None:
+                    exhausted = True
+                else:
+                    callback = None if ordered else (lambda value, i=submitted: finished.put(i))
+                    in_flight[submitted] = pool.apply_async(_call_batch, (func, batch), callback=callback)
+                    submitted += 1
+            if not in_flight:
+                break
+
+            if ordered:
+                i, result = in_flight.popitem(last=False)
+            else:
+                i = None
+                while i not in in_flight:  # Skips numbers of batches already taken below.
+                    try:
+                        i = finished.get(timeout=1.0)
+                    except Queue.Empty:
+                        # Pool errors outside func (like an unpicklable result) don't call the callback.
+                        i = next((j for j, r in in_flight.iteritems() if r.ready()), None)
+                result = in_flight.pop(i)
+
+            ok, value, tb = result.get()
+            if not ok:
+                logger.error('parallel_batches worker failed:\n%s', tb)
+                raise value
+            yield value
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _call_batch(func, batch):
+    """Worker for parallel_batches(). Returns (ok, result or exception, traceback text)."""
+    try:
+        return True, func(batch), None
+    except Exception as e:
+        return False, e, traceback.format_exc()
+
+
 def subsample(limit, lst):
     """Yields limit elements from lst, spaced at equal intervals. (as much as possible if the length does not divide exactly).
-    Lst must support len(), can't be a pure iterable.
+    Lst must support len(), can't be a pure iterable. For pure iterables, see reservoir_sample().
+
+    Numpy arrays are gathered in one go with fancy indexing, and a subsampled array is returned instead.
+    Other sequences only access the chosen indexes, so both take O(limit) instead of O(len(lst)).
+    Other containers (sets, dicts) are walked, yielding their iteration order elements (dict keys).
     """
     N = len(lst)
     assert limit > 0
     assert N >= limit
-    
+
+    # Element k is at the first index i with limit * i >= k * N.
+    indexes = [(k * N + limit - 1) // limit for k in xrange(limit)]
+    numpy = sys.modules.get('numpy')  # Not imported here, lst can only be an array if the caller imported Numpy.
+    if numpy is not None and isinstance(lst, numpy.ndarray):
+        return lst[indexes]
+    elif isinstance(lst, collections.Sequence):
+        return (lst[i] for i in indexes)
+    else:
+        return _subsample_iter(limit, lst, N)
+
+
+def _subsample_iter(limit, lst, N):
+    """Walks all of lst, for sized containers without indexing (sets, dicts)."""
     yielded = 0
     passed = 0  # Including yielded elements
     for elem in lst:
@@ -72,8 +168,44 @@ def subsample(limit, lst):
         passed += 1
 
 
+def reservoir_sample(limit, iterable, seed=None, weight=None):
+    """Returns a random sample of limit elements from an iterable of unknown length, in a single pass.
+    Only limit elements are kept in memory. The sample is returned as a list, in iteration order.
+    If the iterable has fewer than limit elements, all are returned.
+
+    seed makes the sample reproducible.
+    weight is an optional function returning a positive weight for each element. Elements are then sampled without
+    replacement with probability proportional to weight (Efraimidis-Spirakis A-Res algorithm).
+    """
+    assert limit > 0
+    rng = random.Random(seed)
+    if weight is None:
+        # Algorithm R: element i replaces a random reservoir slot with probability limit / (i + 1).
+        reservoir = []
+        for i, elem in enumerate(iterable):
+            if i < limit:
+                reservoir.append((i, elem))
+            else:
+                j = rng.randint(0, i)
+                if j < limit:
+                    reservoir[j] = (i, elem)
+        return [elem for i, elem in sorted(reservoir, key=operator.itemgetter(0))]
+    else:
+        # Keep the limit largest keys u ** (1 / w), in a min-heap.
+        heap = []
+        for i, elem in enumerate(iterable):
+            w = weight(elem)
+            assert w > 0, 'Weights must be positive.'
+            key = rng.random() ** (1 / w)
+            if len(heap) < limit:
+                heapq.heappush(heap, (key, i, elem))
+            elif key > heap[0][0]:
+                heapq.heapreplace(heap, (key, i, elem))
+        return [elem for key, i, elem in sorted(heap, key=operator.itemgetter(1))]
+
+
 def avg(lst):
-    """Average value of the list. Must support len()"""
+    """Average value of the list. Must support len(). For streams, see stats.Mean."""
     return sum(lst) / len(lst)
 
 
@@ -100,6 +232,11 @@ class IterablesTest(unittest.TestCase):
         self.assertEqual(list(successive([1, 2, 3], n=3)), [(1, 2, 3)])
         self.assertEqual(list(successive([1, 2, 3, 4], n=3)), [(1, 2, 3), (2, 3, 4)])
 
+    def test_successive_short(self):
+        self.assertEqual(list(successive([], n=2)), [])
+        self.assertEqual(list(successive([1], n=2)), [])
+        self.assertEqual(list(successive(iter('ABC'), n=1)), [('A',), ('B',), ('C',)])
+
     def test_grouper(self):
         self.assertEqual(list(grouper(1, '')), [])
         self.assertEqual(list(grouper(1, 'ABCD')), [('A',), ('B',), ('C',), ('D',)])
@@ -123,12 +260,94 @@ class IterablesTest(unittest.TestCase):
         for n in xrange(1, 1000):
             self.assertEqual(len(list(subsample(n, data))), n)  
 
+    def test_subsample_array(self):
+        import numpy as np
+        result = subsample(3, np.arange(5))
+        self.assertIsInstance(result, np.ndarray)
+        self.assertEqual([0, 2, 4], result.tolist())
+
+    def test_subsample_matches_walk(self):
+        import numpy as np
+        for N in xrange(1, 60):
+            for limit in xrange(1, N + 1):
+                expect = list(_subsample_iter(limit, range(N), N))
+                self.assertEqual(expect, list(subsample(limit, range(N))))
+                self.assertEqual(expect, list(subsample(limit, xrange(N))))
+                self.assertEqual(expect, subsample(limit, np.arange(N)).tolist())
+                self.assertEqual(expect, sorted(subsample(limit, set(range(N)))))
+                keys = {'k{0}'.format(i): i for i in xrange(N)}
+                self.assertEqual(list(_subsample_iter(limit, keys, N)), list(subsample(limit, keys)))
+        self.assertEqual(['a', 'b'], sorted(subsample(2, {'a': 1, 'b': 2})))
+        self.assertEqual([0, 2], list(subsample(2, {0: 'x', 1: 'y', 2: 'z', 3: 'w'})))  # Keys, not values.
+
+    def test_reservoir_sample(self):
+        sample = reservoir_sample(10, (i for i in xrange(1000)), seed=1)
+        self.assertEqual(10, len(sample))
+        self.assertEqual(sorted(sample), sample)
+        self.assertEqual(sample, reservoir_sample(10, xrange(1000), seed=1))
+        self.assertEqual([0, 1, 2], reservoir_sample(10, xrange(3)))
+
+    def test_reservoir_sample_uniform(self):
+        counts = collections.Counter()
+        for seed in xrange(2000):
+            counts.update(reservoir_sample(2, xrange(10), seed=seed))
+        self.assertEqual(4000, sum(counts.values()))
+        self.assertTrue(all(300 < counts[i] < 500 for i in xrange(10)), counts)
+
+    def test_reservoir_sample_weighted(self):
+        counts = collections.Counter()
+        for seed in xrange(1000):
+            counts.update(reservoir_sample(1, 'ab', seed=seed, weight=lambda c: 9 if c == 'a' else 1))
+        self.assertTrue(850 < counts['a'] < 950, counts)
+
     def test_avg(self):
         self.assertEqual(avg([5]), 5)
         self.assertEqual(avg([1,2,3]), 2)
         self.assertEqual(avg([2,3]), 2.5)
 
 
+class ParallelBatchesTest(unittest.TestCase):
+    def test_ordered(self):
+        result = list(parallel_batches(xrange(10), 3, sum, workers=2))
+        self.assertEqual([3, 12, 21, 9], result)
+
+    def test_threads_unordered(self):
+        def slow_first(batch):
+            if batch[0] == 0:
+                time.sleep(0.1)
+            return batch
+        result = list(parallel_batches(xrange(6), 2, slow_first, workers=3, ordered=False, processes=False))
+        self.assertEqual([[0, 1], [2, 3], [4, 5]], sorted(result))
+        self.assertEqual([0, 1], result[-1])
+
+    def test_empty(self):
+        self.assertEqual([], list(parallel_batches([], 3, sum, workers=2, processes=False)))
+
+    def test_bounded(self):
+        consumed = []
+        def source():
+            for i in xrange(1000):
+                consumed.append(i)
+                yield i
+        results = parallel_batches(source(), 10, len, workers=2, processes=False, max_in_flight=3)
+        next(results)
+        self.assertLessEqual(len(consumed), 4 * 10 + 1)
+        results.close()
+
+    def test_exception(self):
+        def fail(batch):
+            raise ValueError('bad batch')
+        logging.disable(logging.ERROR)
+        try:
+            self.assertRaises(ValueError, list, parallel_batches(xrange(10), 3, fail, workers=2, processes=False))
+        finally:
+            logging.disable(logging.NOTSET)
+
+    def test_unpicklable_result(self):
+        # Fails in the pool, without calling the callback used for ordered=False.
+        self.assertRaises(Exception, list, parallel_batches(xrange(4), 2, iter, workers=2, ordered=False))
+
+
 class FirstTest(unittest.TestCase):
     def test_list(self):
         self.assertEqual(1, first([1]))
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+"""
+MinHash signatures and a banded LSH index, for approximate tanimoto() search over large corpora of sets.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+from future_builtins import *  # ascii, filter, hex, map, oct, zip
+
+import cPickle
+import numpy as np
+import tempfile
+import unittest
+import zlib
+
+from pyshort.stats import tanimoto
+
+_PRIME = (1 << 31) - 1  # a * x + b stays below 2 ** 63 for 32-bit x, so uint64 arithmetic does not overflow.
+_EMPTY = np.uint32(0xffffffff)  # Signature value of an empty set.
+
+
+def element_hashes(elems):
+    """Returns a uint64 array with a 32-bit hash for each element.
+
+    Integers are used as they are (modulo 2 ** 32), other elements are hashed with crc32 of their unicode text,
+    which is stable across processes and Python versions, unlike hash().
+    Each element hashes the same way whatever else is in the set, so mixed sets compare correctly.
+    """
+    elems = list(elems)
+    if all(isinstance(e, (int, long, np.integer)) for e in elems):
+        try:
+            return np.array(elems, dtype=np.int64).astype(np.uint64) & np.uint64(0xffffffff)
+        except OverflowError:
+            pass  # IDs of 2 ** 63 or more, reduced one by one below.
+    # int() first, since np.uint64 & int is not defined in Numpy.
+    return np.array([(int(e) if isinstance(e, (int, long, np.integer)) else zlib.crc32(unicode(e).encode('utf-8')))
+                     & 0xffffffff for e in elems], dtype=np.uint64)
+
+
+class MinHash(object):
+    """Computes MinHash signatures with num_perm random hash functions (a * x + b) mod prime.
+
+    The fraction of equal signature values of two sets estimates their tanimoto() similarity,
+    with a standard error of about 1 / sqrt(num_perm). Use the same num_perm and seed to compare signatures.
+    """
+
+    def __init__(self, num_perm=128, seed=1):
+        self.num_perm = num_perm
+        self.seed = seed
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, _PRIME, size=num_perm).astype(np.uint64)
+        self.b = rng.randint(0, _PRIME, size=num_perm).astype(np.uint64)
+
+    def signature(self, elems):
+        """Returns a uint32 signature array of length num_perm."""
+        hashes = element_hashes(elems)
+        if not len(hashes):
+            return np.full(self.num_perm, _EMPTY, dtype=np.uint32)
+        values = (self.a[:, np.newaxis] * hashes[np.newaxis, :] + self.b[:, np.newaxis]) % np.uint64(_PRIME)
+        return values.min(axis=1).astype(np.uint32)
+
+    def signatures(self, sets, block_elems=1 << 16):
+        """Returns a (len(sets), num_perm) uint32 array of signatures.
+
+        Sets are hashed together in blocks of about block_elems elements, with np.minimum.reduceat per set.
+        """
+        sets = [element_hashes(elems) for elems in sets]
+        sigs = np.full((len(sets), self.num_perm), _EMPTY, dtype=np.uint32)
+        start = 0
+        while start < len(sets):
+            stop, total = start, 0
+            while stop < len(sets) and (stop == start or total + len(sets[stop]) <= block_elems):
+                total += len(sets[stop])
+                stop += 1
+            lengths = np.array([len(h) for h in sets[start:stop]])
+            nonempty, = np.nonzero(lengths)
+            if len(nonempty):
+                hashes = np.concatenate(sets[start:stop])
+                values = (self.a[:, np.newaxis] * hashes[np.newaxis, :] + self.b[:, np.newaxis]) % np.uint64(_PRIME)
+                offsets = (np.cumsum(lengths) - lengths)[nonempty]
+                sigs[start + nonempty] = np.minimum.reduceat(values, offsets, axis=1).T
+            start = stop
+        return sigs
+
+    @staticmethod
+    def estimate(sig1, sig2):
+        """Estimated tanimoto similarity of two signatures. sig2 can also be a 2D array of signatures."""
+        return (np.asarray(sig1) == np.asarray(sig2)).mean(axis=-1)
+
+
+def optimal_bands(num_perm, threshold):
+    """Returns (bands, rows) with bands * rows == num_perm, for an LSH index with the given similarity threshold.
+
+    Two sets become candidates with probability 1 - (1 - s ** rows) ** bands at similarity s.
+    Picks the split whose steepest point, about (1 / bands) ** (1 / rows), is closest to the threshold.
+    """
+    splits = [(b, num_perm // b) for b in xrange(1, num_perm + 1) if num_perm % b == 0]
+    return min(splits, key=lambda br: abs((1 / br[0]) ** (1 / br[1]) - threshold))
+
+
+class LSHIndex(object):
+    """Banded LSH index of MinHash signatures, for finding sets with tanimoto similarity above a threshold.
+
+    Signatures are split into bands of rows values. Sets sharing all values of any band are candidates,
+    and candidates are then filtered by their estimated similarity.
+    Lower thresholds give more candidates (fewer misses, slower queries), tune with threshold or bands.
+    """
+
+    def __init__(self, threshold=0.5, num_perm=128, bands=None, seed=1):
+        if bands is None:
+            bands, rows = optimal_bands(num_perm, threshold)
+        else:
+            assert num_perm % bands == 0, 'bands must divide num_perm.'
+            rows = num_perm // bands
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = rows
+        self.minhash = MinHash(num_perm, seed)
+        self.keys = []
+        self._signatures = []  # Parallel to self.keys.
+        self._positions = {}  # Key -> position in self.keys.
+        self._tables = [{} for i in xrange(bands)]  # Band bytes -> list of positions.
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def insert(self, key, elems=None, signature=None):
+        """Adds a set (or its precomputed signature) under a new key."""
+        if key in self._positions:
+            raise KeyError('Key {0!r} is already in the index.'.format(key))
+        if signature is None:
+            signature = self.minhash.signature(elems)
+        pos = len(self.keys)
+        self.keys.append(key)
+        self._signatures.append(signature)
+        self._positions[key] = pos
+        for table, band in zip(self._tables, self._band_keys(signature)):
+            table.setdefault(band, []).append(pos)
+
+    def insert_many(self, keys, sets):
+        for key, sig in zip(keys, self.minhash.signatures(sets)):
+            self.insert(key, signature=sig)
+
+    def query(self, elems=None, signature=None, threshold=None):
+        """Returns [(key, estimated similarity)] of indexed sets with estimate >= threshold, most similar first.
+
+        threshold defaults to the index threshold.
+        """
+        if threshold is None:
+            threshold = self.threshold
+        if signature is None:
+            signature = self.minhash.signature(elems)
+        candidates = set()
+        for table, band in zip(self._tables, self._band_keys(signature)):
+            candidates.update(table.get(band, ()))
+        if not candidates:
+            return []
+        positions = np.array(sorted(candidates))
+        estimates = MinHash.estimate(signature, np.array([self._signatures[p] for p in positions]))
+        order = np.argsort(-estimates, kind='mergesort')
+        return [(self.keys[positions[i]], estimates[i]) for i in order if estimates[i] >= threshold]
+
+    def save(self, filename):
+        state = {'threshold': self.threshold, 'num_perm': self.minhash.num_perm, 'bands': self.bands,
+                 'seed': self.minhash.seed, 'keys': self.keys,
+                 'signatures': np.array(self._signatures, dtype=np.uint32).reshape(-1, self.minhash.num_perm)}
+        with open(filename, 'wb') as f:
+            cPickle.dump(state, f, -1)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            state = cPickle.load(f)
+        index = cls(state['threshold'], num_perm=state['num_perm'], bands=state['bands'], seed=state['seed'])
+        for key, sig in zip(state['keys'], state['signatures']):
+            index.insert(key, signature=sig)
+        return index
+
+    def _band_keys(self, signature):
+        signature = np.ascontiguousarray(signature, dtype=np.uint32)
+        return [signature[i * self.rows:(i + 1) * self.rows].tostring() for i in xrange(self.bands)]
+
+
+class SimilarSetsTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.base = set(rng.randint(0, 10 ** 6, size=200).tolist())
+
+    def similar(self, overlap):
+        """A set sharing overlap elements with self.base."""
+        base = sorted(self.base)
+        return set(base[:overlap] + range(-1, -(len(base) - overlap) - 1, -1))
+
+
+class MinHashTest(SimilarSetsTestCase):
+    def test_estimate_matches_tanimoto(self):
+        minhash = MinHash(num_perm=256)
+        base_sig = minhash.signature(self.base)
+        for overlap in [0, 50, 100, 150, 200]:
+            other = self.similar(overlap)
+            estimate = MinHash.estimate(base_sig, minhash.signature(other))
+            self.assertAlmostEqual(tanimoto(self.base, other), estimate, delta=0.1)
+
+    def test_strings(self):
+        minhash = MinHash()
+        a = minhash.signature(['foo', 'bar', 'baz'])
+        self.assertEqual(1.0, MinHash.estimate(a, minhash.signature(['baz', 'foo', 'bar'])))
+        self.assertLess(MinHash.estimate(a, minhash.signature(['foo', 'qux', 'quux'])), 1.0)
+
+    def test_mixed_types(self):
+        minhash = MinHash(num_perm=256)
+        ints = set(range(100))
+        for other in [ints | set(['x']), set(range(50)) | set(['a', 'b']), set(map(unicode, range(100)))]:
+            estimate = MinHash.estimate(minhash.signature(ints), minhash.signature(other))
+            self.assertAlmostEqual(tanimoto(ints, other), estimate, delta=0.1)
+        self.assertTrue(np.array_equal(element_hashes([7, 'x'])[:1], element_hashes([7])))
+
+    def test_large_ids(self):
+        self.assertEqual([2 ** 32 - 1, 3, 5], element_hashes([2 ** 70 - 1, 3, np.uint64(2 ** 63 + 5)]).tolist())
+        self.assertEqual(1, element_hashes([np.uint64(2 ** 64 - 2 ** 32 + 1), 'x'])[0])
+        minhash = MinHash(num_perm=16)
+        self.assertEqual(1.0, MinHash.estimate(minhash.signature([2 ** 64 + 3]), minhash.signature([3])))
+
+    def test_empty(self):
+        minhash = MinHash(num_perm=16)
+        self.assertEqual(0, MinHash.estimate(minhash.signature([]), minhash.signature([1])))
+
+    def test_signatures_match_signature(self):
+        minhash = MinHash(num_perm=32)
+        sets = [self.base, set(), set([1]), self.similar(10), set(), ['a', 'b']]
+        expected = np.array([minhash.signature(elems) for elems in sets])
+        for block_elems in [1, 150, 1 << 16]:
+            self.assertTrue(np.array_equal(expected, minhash.signatures(sets, block_elems=block_elems)))
+
+    def test_optimal_bands(self):
+        self.assertEqual(128, np.prod(optimal_bands(128, 0.5)))
+        low_bands, low_rows = optimal_bands(128, 0.2)
+        high_bands, high_rows = optimal_bands(128, 0.9)
+        self.assertGreater(low_bands, high_bands)
+
+
+class LSHIndexTest(SimilarSetsTestCase):
+    def test_query(self):
+        index = LSHIndex(threshold=0.5)
+        index.insert_many(['same', 'close', 'far'], [self.base, self.similar(180), self.similar(20)])
+        result = index.query(self.base)
+        self.assertEqual(['same', 'close'], [key for key, estimate in result])
+        self.assertEqual(1.0, result[0][1])
+        self.assertEqual([], index.query(set(range(-1000, -800))))
+
+    def test_query_mixed_types(self):
+        index = LSHIndex(threshold=0.5)
+        index.insert('mixed', self.base | set(['x', 'y']))
+        self.assertEqual(['mixed'], [key for key, estimate in index.query(self.base)])
+
+    def test_duplicate_key(self):
+        index = LSHIndex()
+        index.insert('a', [1, 2])
+        self.assertRaises(KeyError, index.insert, 'a', [3])
+
+    def test_save_load(self):
+        index = LSHIndex(threshold=0.7, num_perm=64)
+        index.insert('a', self.base)
+        f = tempfile.NamedTemporaryFile()
+        index.save(f.name)
+        loaded = LSHIndex.load(f.name)
+        self.assertEqual((index.bands, index.rows), (loaded.bands, loaded.rows))
+        self.assertEqual(index.query(self.similar(190)), loaded.query(self.similar(190)))
+        loaded.insert('b', [1, 2, 3])
+        self.assertIn('b', loaded)
+
+
+if __name__ == '__main__':
+    unittest.main()
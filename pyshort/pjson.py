@@ -1,25 +1,359 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 from future_builtins import *  # ascii, filter, hex, map, oct, zip
 
+import base64
+import gzip
+import io
 import json
 import numpy as np
+from numpy.lib.format import descr_to_dtype, dtype_to_descr
+import tempfile
+import unittest
+
+
+ARRAY_TAG = '__ndarray__'
+_BASE64_CHUNK = 3 * (1 << 16)  # Multiple of 3 bytes, so base64 of consecutive chunks concatenates.
 
 
 class NumpyJSONEncoder(json.JSONEncoder):
+    binary_arrays = False
+
     def default(self, obj):
-        if isinstance(obj, np.bool):
-            return bool(obj)
-        for dtype in [np.int, np.int32, np.int64]:  # Could add more
-            if isinstance(obj, dtype):
-                return int(obj)
-        for dtype in [np.float, np.float32, np.float64]:
-            if isinstance(obj, dtype):
-                return float(obj)
-        if isinstance(obj, np.ndarray) and obj.ndim == 1:
-            return list(obj)
+        if isinstance(obj, np.ndarray):
+            if self.binary_arrays and not obj.dtype.hasobject:
+                return {ARRAY_TAG: base64.b64encode(np.ascontiguousarray(obj).tobytes()).decode('ascii'),
+                        'dtype': dtype_to_descr(obj.dtype), 'shape': list(obj.shape)}
+            # One bulk conversion to Python lists of Python scalars, instead of a default() call per element.
+            return obj.tolist()
+        if isinstance(obj, np.generic):
+            value = obj.item()
+            # item() returns the scalar itself for types without a Python equivalent, like longdouble.
+            if not isinstance(value, np.generic):
+                return value
         return super(NumpyJSONEncoder, self).default(obj)
 
 
+class BinaryNumpyJSONEncoder(NumpyJSONEncoder):
+    """Encodes arrays as {"__ndarray__": base64 raw bytes, "dtype": "<f8", "shape": [...]}, restored by loads().
+
+    The dtype is written with np.lib.format.dtype_to_descr(), like in .npy headers, so structured dtypes keep
+    their fields. Several times smaller and faster than decimal text, and exact for all dtypes and byte orders.
+    Object arrays are still encoded as lists.
+    """
+    binary_arrays = True
+
+
+def _encoder_class(kwargs):
+    return BinaryNumpyJSONEncoder if kwargs.pop('binary_arrays', False) else NumpyJSONEncoder
+
+
 def dumps(obj, *args, **kwargs):
-    kwargs['cls'] = NumpyJSONEncoder
+    """json.dumps() with Numpy support. With binary_arrays=True, arrays are encoded by BinaryNumpyJSONEncoder."""
+    kwargs['cls'] = _encoder_class(kwargs)
     return json.dumps(obj, *args, **kwargs)
+
+
+def decode_array(dct):
+    """object_hook for json.loads(), turning objects from BinaryNumpyJSONEncoder back into arrays."""
+    if ARRAY_TAG in dct:
+        # bytearray keeps the array writeable, np.frombuffer() on a str would be read-only.
+        data = bytearray(base64.b64decode(dct[ARRAY_TAG]))
+        return np.frombuffer(data, dtype=descr_to_dtype(_descr_from_json(dct['dtype']))).reshape(dct['shape'])
+    return dct
+
+
+def _descr_from_json(descr):
+    """Turns a dtype_to_descr() value back from JSON, which has lists instead of tuples and unicode names."""
+    if not isinstance(descr, list):
+        return str(descr)
+    fields = []
+    for field in descr:
+        name = tuple(str(n) for n in field[0]) if isinstance(field[0], list) else str(field[0])  # (title, name).
+        fields.append((name, _descr_from_json(field[1])) + tuple(tuple(shape) for shape in field[2:]))
+    return fields
+
+
+def loads(s, *args, **kwargs):
+    """json.loads() that restores arrays encoded with binary_arrays=True. Other objects are passed to object_hook."""
+    kwargs['object_hook'] = _chain_hook(kwargs.get('object_hook'))
+    return json.loads(s, *args, **kwargs)
+
+
+def load(fp, *args, **kwargs):
+    kwargs['object_hook'] = _chain_hook(kwargs.get('object_hook'))
+    return json.load(fp, *args, **kwargs)
+
+
+def _chain_hook(object_hook):
+    if object_hook is None:
+        return decode_array
+    return lambda dct: decode_array(dct) if ARRAY_TAG in dct else object_hook(dct)
+
+
+def iterencode(obj, chunk_size=1 << 16, **kwargs):
+    """Yields the JSON encoding of obj in pieces, like dumps(obj, **kwargs) split up.
+
+    Arrays anywhere in nested dicts, lists and tuples are encoded chunk_size elements at a time,
+    so neither their full tolist() nor the whole JSON string is ever in memory. indent is not supported.
+    binary_arrays=True works as in dumps().
+    """
+    assert kwargs.get('indent') is None, 'iterencode() does not support indent.'
+    encoder = _encoder_class(kwargs)(**kwargs)
+    return _iterencode(obj, encoder, chunk_size)
+
+
+def dump(obj, fp, chunk_size=1 << 16, **kwargs):
+    """Writes the JSON encoding of obj to the file object fp with iterencode()."""
+    for chunk in iterencode(obj, chunk_size, **kwargs):
+        fp.write(chunk)
+
+
+def _iterencode(obj, encoder, chunk_size):
+    if isinstance(obj, np.ndarray) and encoder.binary_arrays and not obj.dtype.hasobject:
+        for chunk in _iterencode_binary_array(obj, encoder):
+            yield chunk
+    elif isinstance(obj, np.ndarray) and obj.ndim > 0:
+        for chunk in _iterencode_array(obj, encoder, chunk_size):
+            yield chunk
+    elif isinstance(obj, dict):
+        items = sorted(obj.iteritems()) if encoder.sort_keys else obj.iteritems()
+        yield '{'
+        for i, (key, value) in enumerate(items):
+            if not isinstance(key, basestring):
+                key = encoder.encode(key)  # JSON object keys are strings, like json.dumps({1: 2}) == '{"1": 2}'.
+            yield (encoder.item_separator if i else '') + encoder.encode(key) + encoder.key_separator
+            for chunk in _iterencode(value, encoder, chunk_size):
+                yield chunk
+        yield '}'
+    elif isinstance(obj, (list, tuple)):
+        yield '['
+        for i, value in enumerate(obj):
+            if i:
+                yield encoder.item_separator
+            for chunk in _iterencode(value, encoder, chunk_size):
+                yield chunk
+        yield ']'
+    else:
+        yield encoder.encode(obj)
+
+
+def _iterencode_array(arr, encoder, chunk_size):
+    """Encodes blocks of rows along the first axis, stripping the brackets of each block's list."""
+    rows = max(1, chunk_size // max(1, arr[0].size if len(arr) else 1))
+    yield '['
+    for start in xrange(0, len(arr), rows):
+        if start:
+            yield encoder.item_separator
+        yield encoder.encode(arr[start:start + rows].tolist())[1:-1]
+    yield ']'
+
+
+def _iterencode_binary_array(arr, encoder):
+    """Same object as BinaryNumpyJSONEncoder.default(), with the base64 data encoded a chunk at a time."""
+    sep, key_sep = encoder.item_separator, encoder.key_separator
+    yield '{{"dtype"{0}{1}{2}"shape"{0}{3}{2}"{4}"{0}"'.format(
+        key_sep, encoder.encode(dtype_to_descr(arr.dtype)), sep, encoder.encode(list(arr.shape)), ARRAY_TAG)
+    data = memoryview(np.ascontiguousarray(arr).reshape(-1).view(np.uint8))
+    for start in xrange(0, len(data), _BASE64_CHUNK):
+        yield base64.b64encode(data[start:start + _BASE64_CHUNK].tobytes()).decode('ascii')
+    yield '"}'
+
+
+class NDJSONWriter(object):
+    """Writes records as newline-delimited JSON, one encoded record per line, flushing every batch_size records.
+
+    Records can be anything dumps() accepts. compress=None gzips filenames ending with .gz.
+    Other keyword arguments (like binary_arrays=True) are passed on to the encoder, indent is not supported.
+    Use as a context manager, or call close().
+    """
+
+    def __init__(self, filename, compress=None, batch_size=1000, **kwargs):
+        assert kwargs.get('indent') is None, 'NDJSON records must be on one line.'
+        if compress is None:
+            compress = filename.endswith('.gz')
+        self.file = gzip.open(filename, 'wb') if compress else open(filename, 'wb')
+        self.encoder = _encoder_class(kwargs)(**kwargs)
+        self.batch_size = batch_size
+        self.count = 0
+        self._batch = []
+
+    def write(self, record):
+        self._batch.append(self.encoder.encode(record))
+        self.count += 1
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        if self._batch:
+            self._batch.append('')
+            self.file.write('\n'.join(self._batch).encode('utf-8'))
+            self._batch = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_ndjson(filename, records, compress=None, batch_size=1000, **kwargs):
+    """Writes records from an iterable with NDJSONWriter, returns the number of records."""
+    with NDJSONWriter(filename, compress, batch_size, **kwargs) as writer:
+        writer.write_all(records)
+    return writer.count
+
+
+def _open_ndjson(filename):
+    """Opens plain or gzip-compressed files, detected by the gzip magic bytes."""
+    with open(filename, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    return io.BufferedReader(gzip.open(filename, 'rb')) if compressed else open(filename, 'rb')
+
+
+def read_ndjson(filename, **kwargs):
+    """Yields records from a file written by NDJSONWriter, decoded with loads(). Blank lines are skipped."""
+    with _open_ndjson(filename) as f:
+        for line in f:
+            if line.strip():
+                yield loads(line.decode('utf-8'), **kwargs)
+
+
+def read_ndjson_columns(filename, fields, batch_size=100000, dtypes=None):
+    """Yields {field: array} for each batch of up to batch_size records, with only the given fields.
+
+    dtypes optionally maps fields to array dtypes, otherwise np.array() chooses.
+    Only one batch of Python values is in memory at a time.
+    """
+    dtypes = dtypes or {}
+    columns = {field: [] for field in fields}
+    count = 0
+    for record in read_ndjson(filename):
+        for field in fields:
+            columns[field].append(record[field])
+        count += 1
+        if count == batch_size:
+            yield _to_arrays(columns, dtypes)
+            columns = {field: [] for field in fields}
+            count = 0
+    if count:
+        yield _to_arrays(columns, dtypes)
+
+
+def _to_arrays(columns, dtypes):
+    return {field: np.array(values, dtype=dtypes.get(field)) for field, values in columns.iteritems()}
+
+
+class PJSONTest(unittest.TestCase):
+    def test_dtypes(self):
+        for dtype in [np.bool_, np.int8, np.int16, np.int32, np.int64, np.uint8, np.uint16, np.uint32, np.uint64,
+                      np.float16, np.float32, np.float64]:
+            arr = np.arange(6).astype(dtype)
+            self.assertEqual(json.dumps(arr.tolist()), dumps(arr))
+            self.assertEqual(json.dumps(arr[1].item()), dumps(arr[1]))
+
+    def test_ndim(self):
+        arr = np.arange(24, dtype=np.float32).reshape(2, 3, 4) / 4
+        self.assertEqual(arr.tolist(), json.loads(dumps(arr)))
+        self.assertEqual(3, json.loads(dumps(np.array(3))))
+        self.assertEqual([[]], json.loads(dumps(np.zeros((1, 0)))))
+
+    def test_unsupported_scalars(self):
+        self.assertRaises(TypeError, dumps, np.longdouble(1.5))
+        self.assertRaises(TypeError, dumps, np.array([1.5], dtype=np.longdouble))
+
+    def test_iterencode(self):
+        obj = {'a': np.arange(1000).reshape(100, 10), 1: [np.zeros(0), np.arange(7) / 2, np.float32(0.5)],
+               'b': (np.int64(3), None, 'x')}
+        for chunk_size in [1, 3, 25, 1 << 16]:
+            self.assertEqual(dumps(obj, sort_keys=True), ''.join(iterencode(obj, chunk_size, sort_keys=True)))
+        compact = {'separators': (',', ':'), 'sort_keys': True}
+        self.assertEqual(dumps(obj, **compact), ''.join(iterencode(obj, 7, **compact)))
+        f = tempfile.TemporaryFile()
+        dump(obj, f, chunk_size=5)
+        f.seek(0)
+        self.assertEqual(json.loads(dumps(obj)), json.load(f))
+
+    def test_binary_round_trip(self):
+        rng = np.random.RandomState(0)
+        structured = [[('x', '<i4'), ('y', '>f8', (2,))], [('a', [('b', 'u1'), ('c', '<u2')]), ('d', 'S3')],
+                      {'names': [b'a', b'b'], 'formats': ['u1', '<f8'], 'offsets': [0, 8]}]  # With padding.
+        for dtype in [np.bool_, np.int8, np.int16, np.int32, np.int64, np.uint8, np.uint16, np.uint32, np.uint64,
+                      np.float16, np.float32, np.float64, np.complex64, np.complex128, 'S5', 'U3', 'M8[s]',
+                      'V4'] + structured:
+            for byteorder in '<>':
+                dt = np.dtype(dtype).newbyteorder(byteorder)
+                if dt.kind == 'b':
+                    arr = rng.random_sample((3, 4)) < 0.5
+                else:
+                    arr = np.frombuffer(rng.bytes(12 * dt.itemsize), dtype=dt).reshape(3, 4)  # Any bit patterns.
+                for encoded in [dumps({'a': arr}, binary_arrays=True),
+                                ''.join(iterencode({'a': arr}, binary_arrays=True))]:
+                    decoded = loads(encoded)['a']
+                    self.assertEqual(arr.dtype, decoded.dtype)
+                    self.assertEqual(arr.tobytes(), decoded.tobytes())
+        for fmt in ['<i2', '>i2']:  # Not with newbyteorder(), which drops the title from the original dtype.
+            arr = np.arange(3).astype([((b'Title', b't'), fmt)])
+            decoded = loads(dumps(arr, binary_arrays=True))
+            self.assertEqual(arr.dtype, decoded.dtype)
+            self.assertEqual([0, 1, 2], decoded['Title'].tolist())
+        for arr in [np.zeros((0, 3)), np.array(2.5), np.arange(12).reshape(3, 4).T]:
+            decoded = loads(dumps(arr, binary_arrays=True))
+            self.assertEqual(arr.shape, decoded.shape)
+            self.assertTrue(np.array_equal(arr, decoded))
+        decoded[...] = 0  # Writeable.
+
+    def test_binary_large_array(self):
+        arr = np.random.RandomState(0).random_sample(3 * (1 << 15) + 1)  # More than two base64 chunks.
+        f = tempfile.TemporaryFile()
+        dump([arr, {'b': 1}], f, binary_arrays=True)
+        f.seek(0)
+        decoded = load(f, object_hook=lambda dct: dct.keys())
+        self.assertTrue(np.array_equal(arr, decoded[0]))
+        self.assertEqual(['b'], decoded[1])
+        self.assertLess(len(dumps(arr, binary_arrays=True)), len(dumps(arr)) / 1.5)
+
+
+class NDJSONTest(unittest.TestCase):
+    def setUp(self):
+        self.records = [{'id': i, 'score': np.float32(i / 4), 'name': 'r{0}'.format(i), 'vec': np.arange(i % 3)}
+                        for i in xrange(10)]
+
+    def test_round_trip(self):
+        for suffix, compress in [('.ndjson', None), ('.ndjson.gz', None), ('.ndjson', True)]:
+            f = tempfile.NamedTemporaryFile(suffix=suffix)
+            self.assertEqual(10, write_ndjson(f.name, iter(self.records), compress=compress, batch_size=3))
+            decoded = list(read_ndjson(f.name))
+            self.assertEqual(json.loads(dumps(self.records)), decoded)
+            with open(f.name, 'rb') as raw:
+                self.assertEqual(suffix.endswith('.gz') or bool(compress), raw.read(2) == b'\x1f\x8b')
+
+    def test_binary_arrays(self):
+        f = tempfile.NamedTemporaryFile(suffix='.ndjson.gz')
+        with NDJSONWriter(f.name, binary_arrays=True) as writer:
+            writer.write_all(self.records)
+        for record, decoded in zip(self.records, read_ndjson(f.name)):
+            self.assertEqual(record['vec'].dtype, decoded['vec'].dtype)
+            self.assertTrue(np.array_equal(record['vec'], decoded['vec']))
+
+    def test_columns(self):
+        f = tempfile.NamedTemporaryFile(suffix='.ndjson')
+        write_ndjson(f.name, self.records)
+        batches = list(read_ndjson_columns(f.name, ['id', 'score'], batch_size=4, dtypes={'score': np.float32}))
+        self.assertEqual([4, 4, 2], [len(batch['id']) for batch in batches])
+        self.assertEqual(['id', 'score'], sorted(batches[0].keys()))
+        self.assertEqual(np.float32, batches[0]['score'].dtype)
+        self.assertTrue(np.array_equal(np.arange(10) / 4, np.concatenate([b['score'] for b in batches])))
+        empty = tempfile.NamedTemporaryFile()
+        self.assertEqual([], list(read_ndjson_columns(empty.name, ['id'])))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,11 +4,24 @@ Utilities for matplotlib.
 from __future__ import absolute_import, division, print_function, unicode_literals
 from future_builtins import *  # ascii, filter, hex, map, oct, zip
 
+import cPickle
+import hashlib
+import inspect
 import logging
 import matplotlib
 from matplotlib import cm as mcm
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import PolyCollection
+from matplotlib.figure import Figure
+import multiprocessing
 import numpy as np
+import os
+import shutil
 import sys
+import tempfile
+import unittest
+
+from pyshort.arrays import ragged_offsets, ragged_percentiles
 
 
 logger = logging.getLogger(__name__)
@@ -58,20 +71,155 @@ def rc_print_settings():
     matplotlib.rc('savefig', dpi=300, format='pdf', bbox='tight')
 
 
+RENDER_MANIFEST = '.render_cache.pickle'
+
+
+def _source_hash(func):
+    """Identifies a function by module, name and source code, so that editing it changes the hash."""
+    try:
+        source = inspect.getsource(func)
+    except (IOError, TypeError):
+        source = ''
+    return (func.__module__, func.__name__, source)
+
+
+def _render_one(job):
+    """Pool worker for render_figures(). Draws on a new Figure, without pyplot or an interactive backend."""
+    path, spec, data = job
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    spec(fig, data)
+    # Save under a temporary name, so an interrupted run never leaves a partial figure that looks up to date.
+    root, ext = os.path.splitext(path)
+    tmp_path = '{0}.tmp-{1}{2}'.format(root, os.getpid(), ext)
+    fig.savefig(tmp_path)
+    os.rename(tmp_path, path)
+    return path
+
+
+def render_figures(jobs, output_dir, workers=None, rc=None, force=False):
+    """Renders many figures in a process pool, skipping figures whose spec and data did not change since the last run.
+
+    jobs is a list of (filename, spec, data). spec(fig, data) draws into a new matplotlib Figure, which is then
+    saved to output_dir/filename, with the format from the extension (for example PDF). spec must be a module-level
+    function, and data picklable. rc is an optional function run once in each worker to configure matplotlib,
+    for example rc_print_settings.
+
+    A figure is skipped if its file exists and the hash of its spec source code, data and rc is unchanged.
+    Hashes are kept in output_dir/.render_cache.pickle. force=True renders everything.
+    workers defaults to the number of CPUs, workers=1 renders in this process.
+    Returns the list of filenames that were rendered.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    manifest_path = os.path.join(output_dir, RENDER_MANIFEST)
+    try:
+        with open(manifest_path, 'rb') as f:
+            manifest = cPickle.load(f)
+    except (IOError, EOFError, cPickle.UnpicklingError):
+        manifest = {}
+
+    todo = []
+    hashes = {}
+    rc_hash = _source_hash(rc) if rc is not None else None
+    for filename, spec, data in jobs:
+        digest = hashlib.sha1(cPickle.dumps((_source_hash(spec), rc_hash, data), 2)).hexdigest()
+        path = os.path.join(output_dir, filename)
+        hashes[path] = (filename, digest)
+        if force or manifest.get(filename) != digest or not os.path.exists(path):
+            todo.append((path, spec, data))
+    print('Rendering {0} of {1} figures into {2}.'.format(len(todo), len(jobs), output_dir), file=sys.stderr)
+
+    rendered = []
+
+    def done(path):
+        filename, digest = hashes[path]
+        manifest[filename] = digest
+        rendered.append(filename)
+
+    pool = None
+    try:
+        if workers == 1 or len(todo) <= 1:
+            # Settings changed by rc are restored afterwards, so they don't leak into the caller's figures.
+            with matplotlib.rc_context():
+                if rc is not None:
+                    rc()
+                for job in todo:
+                    done(_render_one(job))
+        else:
+            pool = multiprocessing.Pool(workers, initializer=rc)
+            for path in pool.imap_unordered(_render_one, todo):
+                done(path)
+            pool.close()
+            pool.join()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        # Remember finished figures even if one failed, so a rerun only redoes the rest.
+        with open(manifest_path, 'wb') as f:
+            cPickle.dump(manifest, f, -1)
+    return rendered
+
+
+class StreamingHistogram(object):
+    """Histogram with fixed, possibly uneven bins, filled chunk by chunk. For data that does not fit in memory.
+
+    Bins and open_end are as in hist_fixed_bins(), and counts equal np.histogram() of all added data:
+    bins are [left, right), except the last one which includes its right edge.
+    total counts all added values, including those outside the bins, like len(data).
+    Histograms with the same bins can be merged, for example from worker processes.
+    """
+
+    def __init__(self, bins, open_end=False):
+        bins = list(bins)
+        if open_end:
+            bins = bins + [float('inf')]
+        self.bins = bins
+        self.edges = np.array(bins, dtype=np.float64)
+        assert len(self.edges) >= 2 and (np.diff(self.edges) > 0).all(), 'Bin edges must be increasing.'
+        self.counts = np.zeros(len(bins) - 1, dtype=np.int64)
+        self.total = 0
+
+    def add(self, data):
+        data = np.asarray(data, dtype=np.float64).ravel()
+        self.total += len(data)
+        idx = np.searchsorted(self.edges, data, side='right') - 1
+        idx[data == self.edges[-1]] = len(self.counts) - 1  # The last bin is closed.
+        idx = idx[(idx >= 0) & (idx < len(self.counts))]
+        self.counts += np.bincount(idx, minlength=len(self.counts))
+
+    def add_all(self, chunks):
+        for chunk in chunks:
+            self.add(chunk)
+        return self
+
+    def merge(self, other):
+        assert np.array_equal(self.edges, other.edges), 'Can only merge histograms with the same bins.'
+        self.counts += other.counts
+        self.total += other.total
+        return self
+
+
 def hist_fixed_bins(axes, data, bins, log=False, open_end=False, normed=False, color='b', alpha=1.0, label=None, ticklabels=None, ticklabels_interval=1):
     """Plots a histogram with given bins, but equal plotted bin widths.
     Useful if bin widths are very unequal.
     open_end=True appends a bin edge at +infinity.
     normed=True makes the values a probability *mass* function: bin counts are divided by the total number of data points (the sum of y values will sum to 1.0).
     If ticklabels is None, tick labels are shown for every ticklabels_interval bin. The first and inf are always shown.
+    data can also be a StreamingHistogram, created with the same bins and open_end.
     """
     if open_end:
         bins = bins + [float('inf')]
 
-    hist, _ = np.histogram(data, bins=bins)
+    if isinstance(data, StreamingHistogram):
+        assert data.bins == list(bins), 'StreamingHistogram must have the same bins and open_end.'
+        hist, total = data.counts, data.total
+    else:
+        hist, _ = np.histogram(data, bins=bins)
+        total = len(data)
     if normed:
         hist = np.array(hist, dtype=np.float64)
-        hist /= len(data)
+        hist /= total
     axes.bar(range(len(hist)), hist, width=0.99, log=log, color=color, alpha=alpha, label=label)
     axes.set_xticks(range(len(bins)))
     if ticklabels is None:
@@ -95,10 +243,101 @@ def set_color_cycle_from_cmap(axes, cmap_name='spectral', num_colors=10, repeat_
     axes.set_color_cycle(colors)
 
 
+class DensityAccumulator(object):
+    """Streaming replacement for the y_samples 2D array of density_fill_plot() and density_line_plot().
+
+    Keeps a fixed-bin histogram of Y samples for each of num_x X values, so memory is num_x * bins counts
+    no matter how many samples are added. Y values must lie in [lo, hi] for the error bound to hold:
+    each percentile is then within error_bound = (hi - lo) / bins of np.percentile(..., interpolation='lower'),
+    and so of the default linear np.percentile() whenever neighbouring samples share a bin (dense data).
+    Values outside the range are counted in the first or last bin. The exact minimum and maximum per X are tracked separately,
+    so percentiles 0 and 100 are exact, and all estimates are clipped to them.
+    """
+
+    def __init__(self, num_x, lo, hi, bins=1024):
+        assert hi > lo
+        self.num_x = num_x
+        self.lo = lo
+        self.hi = hi
+        self.bins = bins
+        self.counts = np.zeros((num_x, bins), dtype=np.int64)
+        self.min = np.full(num_x, np.inf)
+        self.max = np.full(num_x, -np.inf)
+
+    def __len__(self):
+        return self.num_x
+
+    @property
+    def error_bound(self):
+        """Maximum absolute error of percentiles, for samples inside [lo, hi]."""
+        return (self.hi - self.lo) / self.bins
+
+    def add(self, ys, x_indexes=None):
+        """Adds a batch of samples.
+
+        Without x_indexes, ys is a (num_x, k) array with k new samples for each X.
+        Otherwise ys and x_indexes are 1D arrays of equal length, sample ys[i] being for X number x_indexes[i].
+        """
+        ys = np.asarray(ys, dtype=np.float64)
+        if x_indexes is None:
+            assert ys.ndim == 2 and len(ys) == self.num_x, 'ys must have shape (num_x, samples).'
+            x_indexes = np.repeat(np.arange(self.num_x), ys.shape[1])
+            ys = ys.ravel()
+        else:
+            x_indexes = np.asarray(x_indexes)
+            assert ys.shape == x_indexes.shape and ys.ndim == 1
+        keep = ~np.isnan(ys)
+        ys, x_indexes = ys[keep], x_indexes[keep]
+        if not len(ys):
+            return
+        bin_indexes = np.clip(((ys - self.lo) / self.error_bound).astype(np.int64), 0, self.bins - 1)
+        flat_indexes = x_indexes * self.bins + bin_indexes
+        flat_counts = self.counts.reshape(-1)  # A view, counts is C-contiguous.
+        if len(flat_indexes) >= flat_counts.size // 8:
+            flat_counts += np.bincount(flat_indexes, minlength=flat_counts.size)
+        else:
+            # Scattered batch, only touch its bins instead of adding a full num_x * bins array.
+            touched, touched_counts = np.unique(flat_indexes, return_counts=True)
+            flat_counts[touched] += touched_counts
+        np.minimum.at(self.min, x_indexes, ys)
+        np.maximum.at(self.max, x_indexes, ys)
+
+    def merge(self, other):
+        """Adds the samples of another accumulator with the same num_x, lo, hi and bins, for example from a worker."""
+        assert (self.num_x, self.lo, self.hi, self.bins) == (other.num_x, other.lo, other.hi, other.bins)
+        self.counts += other.counts
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+
+    def percentiles(self, percentiles):
+        """Returns an array of shape (len(percentiles), num_x), like np.percentile(y_samples, percentiles, axis=1).
+        X values without samples give nan.
+        """
+        totals = self.counts.sum(axis=1)
+        cumulative = np.cumsum(self.counts, axis=1)
+        result = np.empty((len(percentiles), self.num_x))
+        for i, p in enumerate(percentiles):
+            # Rank (0-based, fractional) of the percentile in each X's sorted samples, as in np.percentile.
+            rank = p / 100 * np.maximum(totals - 1, 0)
+            bin_indexes = np.minimum((cumulative <= rank[:, np.newaxis]).sum(axis=1), self.bins - 1)
+            in_bin = self.counts[np.arange(self.num_x), bin_indexes]
+            before = cumulative[np.arange(self.num_x), bin_indexes] - in_bin
+            # Spread the samples of a bin evenly over its width.
+            fraction = (rank - before + 0.5) / np.maximum(in_bin, 1)
+            result[i] = self.lo + (bin_indexes + np.clip(fraction, 0, 1)) * self.error_bound
+            if p == 0:
+                result[i] = self.min
+            elif p == 100:
+                result[i] = self.max
+        result = np.clip(result, self.min, self.max)
+        result[:, totals == 0] = np.nan
+        return result
+
+
 def _percentile_values(y_samples, percentile_step):
     """Computes percentiles for samples.
 
-    y_samples should be a 2D numpy array or a list of lists of samples.
+    y_samples should be a 2D numpy array or a list of lists of samples, or a DensityAccumulator.
     Each row (outer list) is for one X value, and each column (inner list) is a sample of Y values at that X.
 
     Returns the percentiles list, and a list of numpy arrays.
@@ -110,6 +349,11 @@ def _percentile_values(y_samples, percentile_step):
     assert 50 in percentiles
     assert 100 in percentiles
 
+    if isinstance(y_samples, DensityAccumulator):
+        y_list = y_samples.percentiles(percentiles)
+        assert len(y_list) == len(percentiles)
+        return percentiles, y_list
+
     if isinstance(y_samples, np.ndarray):
         assert len(y_samples.shape) == 2, 'y_samples must be a 2D numpy array or a list of lists of numbers.'
         assert len(y_samples) > 0, 'y_samples must not be empty.'
@@ -129,31 +373,66 @@ def _percentile_values(y_samples, percentile_step):
         # y_samples is a numpy array, can compute percentiles in one go.
         y_list = np.percentile(y_samples, percentiles, axis=1)
     else:
-        # y_samples is a list of lists of uneven lengths. Slow mode.
-        logger.warning('Slow percentile computation: consider switching to 2D numpy arrays.')
-        num_x = len(y_samples)
-        y_list = []
-        for p in percentiles:
-            y_list.append(np.zeros(num_x, dtype=np.float64))
-            for i in xrange(num_x):
-                y_list[-1][i] = np.percentile(y_samples[i], p)
+        # y_samples is a list of lists of uneven lengths. Sort each row once, and interpolate all percentiles together.
+        values, offsets = ragged_offsets(y_samples)
+        y_list = ragged_percentiles(values, offsets, percentiles)
 
     assert len(y_list) == len(percentiles)
     return percentiles, y_list
 
 
-def density_fill_plot(ax, xs, y_samples, percentile_step=5, cmap=mcm.Blues, label=None):
+def decimate_minmax(xs, y_list, max_points):
+    """Reduces xs and each Y array in y_list to at most max_points points, keeping extremes.
+
+    The X range is split into max_points // 2 buckets of consecutive points. Each bucket becomes two points,
+    at its first and last X, with the minimum and maximum of each Y array in the bucket. So peaks narrower than
+    a bucket stay visible, and pointwise ordering of the Y arrays (like percentile lines) is preserved.
+    Returns xs and a 2D array of Y values, unchanged if there are few enough points already.
+    """
+    xs = np.asarray(xs)
+    y_list = np.asarray(y_list)
+    num_buckets = max(max_points // 2, 1)
+    if len(xs) <= max_points:
+        return xs, y_list
+    starts = np.linspace(0, len(xs), num_buckets + 1).astype(np.int64)
+    ends = starts[1:] - 1
+    starts = starts[:-1]
+    new_xs = np.column_stack((xs[starts], xs[ends])).ravel()
+    mins = np.minimum.reduceat(y_list, starts, axis=1)
+    maxs = np.maximum.reduceat(y_list, starts, axis=1)
+    new_ys = np.stack((mins, maxs), axis=2).reshape(len(y_list), -1)
+    return new_xs, new_ys
+
+
+def _max_points(ax, max_points):
+    """Converts max_points='auto' to two points per horizontal pixel of the axes."""
+    if max_points == 'auto':
+        return 2 * int(np.ceil(ax.get_window_extent().width))
+    return max_points
+
+
+def density_fill_plot(ax, xs, y_samples, percentile_step=5, cmap=mcm.Blues, label=None, max_points=None, single_collection=False):
     """Plots density, as sort of a heatmap with linear filled lines.
 
     y_samples must be a 2-dimensional array. Each row is one x value, and each column is a sample from some y distribution.
+    For more samples than fit in memory, pass a DensityAccumulator instead.
     percentile_step ought to divide into 100 evenly.
+
+    For very many X values, max_points decimates the percentile lines with decimate_minmax() before drawing.
+    max_points='auto' uses two points per pixel of the axes width at the current figure size and dpi.
+    single_collection=True draws all bands as one PolyCollection instead of one fill_between() artist per band.
     """
     assert len(xs) == len(y_samples)
     num_x = len(xs)
     assert num_x > 0
 
     percentiles, y_list = _percentile_values(y_samples, percentile_step)
+    max_points = _max_points(ax, max_points)
+    if max_points is not None:
+        xs, y_list = decimate_minmax(xs, y_list, max_points)
 
+    polygons = []
+    colors = []
     for i in xrange(len(percentiles) - 1):
         y1 = y_list[i]
         y2 = y_list[i + 1]
@@ -168,21 +447,33 @@ def density_fill_plot(ax, xs, y_samples, percentile_step=5, cmap=mcm.Blues, labe
         assert distance < 1.0
         color = cmap(distance)[:3]  # Remove alpha
         alpha = distance
-        ax.fill_between(xs, y1, y2, color=color, alpha=alpha)
+        if single_collection:
+            polygons.append(np.concatenate((np.column_stack((xs, y1)), np.column_stack((xs[::-1], y2[::-1])))))
+            colors.append(color + (alpha,))
+        else:
+            ax.fill_between(xs, y1, y2, color=color, alpha=alpha)
+    if single_collection:
+        ax.add_collection(PolyCollection(polygons, facecolors=colors, edgecolors='none'))
+        ax.autoscale_view()
     ax.plot(xs, y_list[len(percentiles) // 2], color=cmap(1.0), label=label)
 
 
-def density_line_plot(ax, xs, y_samples, percentile_step=5, color='b', label=None):
+def density_line_plot(ax, xs, y_samples, percentile_step=5, color='b', label=None, max_points=None):
     """Plots density, as individual thin lines for percentiles.
 
     y_samples must be a 2-dimensional array. Each row is one x value, and each column is a sample from some y distribution.
+    For more samples than fit in memory, pass a DensityAccumulator instead.
     percentile_step ought to divide into 100 evenly.
+    max_points decimates the lines, as in density_fill_plot().
     """
     assert len(xs) == len(y_samples)
     num_x = len(xs)
     assert num_x > 0
 
     percentiles, y_list = _percentile_values(y_samples, percentile_step)
+    max_points = _max_points(ax, max_points)
+    if max_points is not None:
+        xs, y_list = decimate_minmax(xs, y_list, max_points)
 
     for i in xrange(len(percentiles)):
         y = y_list[i]
@@ -199,4 +490,124 @@ def density_line_plot(ax, xs, y_samples, percentile_step=5, color='b', label=Non
             ax.plot(xs, y, color=color, alpha=alpha)
 
 
-
+class DensityAccumulatorTest(unittest.TestCase):
+    def test_error_bound(self):
+        rng = np.random.RandomState(0)
+        samples = rng.uniform(-3, 5, size=(20, 5000))
+        acc = DensityAccumulator(20, -3, 5, bins=200)
+        for batch in np.array_split(samples, 7, axis=1):
+            acc.add(batch)
+        percentiles = range(0, 101, 5)
+        expected = np.percentile(samples, percentiles, axis=1)
+        self.assertLessEqual(np.abs(expected - acc.percentiles(percentiles)).max(), acc.error_bound)
+        self.assertTrue(np.array_equal(samples.min(axis=1), acc.percentiles([0])[0]))
+
+    def test_scattered_and_merge(self):
+        acc = DensityAccumulator(2, 0, 10, bins=10)
+        acc.add([1, 9, 5], x_indexes=[0, 1, 0])
+        other = DensityAccumulator(2, 0, 10, bins=10)
+        other.add([100.0, np.nan], x_indexes=[0, 1])
+        acc.merge(other)
+        self.assertEqual([1, 9], acc.percentiles([0])[0].tolist())
+        self.assertEqual([100, 9], acc.percentiles([100])[0].tolist())
+
+    def test_scattered_counts(self):
+        rng = np.random.RandomState(0)
+        ys, x_indexes = rng.uniform(0, 1, size=500), rng.randint(0, 100, size=500)
+        dense = DensityAccumulator(100, 0, 1, bins=4)  # 500 samples >= 400 / 8 bins, bincount path.
+        dense.add(ys, x_indexes)
+        scattered = DensityAccumulator(100, 0, 1, bins=64)
+        for i in xrange(0, 500, 20):  # Repeated bins within a batch are counted.
+            scattered.add(np.concatenate((ys[i:i + 20], ys[i:i + 20])), np.tile(x_indexes[i:i + 20], 2))
+        self.assertEqual(1000, scattered.counts.sum())
+        self.assertTrue(np.array_equal(2 * dense.counts, scattered.counts.reshape(100, 4, 16).sum(axis=2)))
+
+    def test_no_samples(self):
+        acc = DensityAccumulator(2, 0, 1)
+        acc.add([0.5], x_indexes=[1])
+        result = acc.percentiles([50])
+        self.assertTrue(np.isnan(result[0, 0]))
+        self.assertEqual(0.5, result[0, 1])
+
+
+class DecimateMinmaxTest(unittest.TestCase):
+    def test_keeps_extremes(self):
+        xs = np.arange(1000)
+        ys = np.zeros((2, 1000))
+        ys[0, 123] = -5
+        ys[1, 777] = 7
+        new_xs, new_ys = decimate_minmax(xs, ys, 100)
+        self.assertEqual(100, len(new_xs))
+        self.assertEqual((2, 100), new_ys.shape)
+        self.assertEqual(-5, new_ys[0].min())
+        self.assertEqual(7, new_ys[1].max())
+        self.assertEqual([0, 999], [new_xs[0], new_xs[-1]])
+        self.assertTrue((np.diff(new_xs) >= 0).all())
+
+    def test_short_unchanged(self):
+        xs, ys = decimate_minmax([1, 2, 3], [[1, 2, 3]], 10)
+        self.assertEqual([1, 2, 3], xs.tolist())
+
+
+class StreamingHistogramTest(unittest.TestCase):
+    def test_matches_numpy(self):
+        rng = np.random.RandomState(0)
+        data = np.concatenate((rng.exponential(10, size=1000), [0, 1, 5, 100, -1]))
+        for bins, open_end in [([0, 1, 5, 20, 100], False), ([0, 1, 5, 20], True)]:
+            hist = StreamingHistogram(bins, open_end=open_end).add_all(np.array_split(data, 7))
+            expected, _ = np.histogram(data, bins=bins + [float('inf')] if open_end else bins)
+            self.assertEqual(expected.tolist(), hist.counts.tolist())
+            self.assertEqual(len(data), hist.total)
+
+    def test_merge(self):
+        a = StreamingHistogram([0, 1, 2], open_end=True)
+        a.add([0.5, 1.5, 3])
+        b = StreamingHistogram([0, 1, 2], open_end=True)
+        b.add([float('inf'), -3])
+        self.assertEqual([1, 1, 2], a.merge(b).counts.tolist())
+        self.assertEqual(5, a.total)
+        self.assertRaises(AssertionError, a.merge, StreamingHistogram([0, 1, 2]))
+
+
+def _line_spec(fig, data):
+    """Figure spec for RenderFiguresTest."""
+    fig.add_subplot(111).plot(data)
+
+
+def _linewidth_spec(fig, data):
+    """Figure spec for RenderFiguresTest, recording the line width setting it was drawn with."""
+    data.append(matplotlib.rcParams['lines.linewidth'])
+
+
+def _thick_lines_rc():
+    matplotlib.rc('lines', linewidth=7)
+
+
+class RenderFiguresTest(unittest.TestCase):
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_skip_unchanged(self):
+        jobs = [('a.png', _line_spec, [1, 2, 3]), ('b.pdf', _line_spec, [3, 2, 1])]
+        self.assertEqual(['a.png', 'b.pdf'], sorted(render_figures(jobs, self.dirname, workers=2)))
+        self.assertTrue(os.path.exists(os.path.join(self.dirname, 'b.pdf')))
+        self.assertEqual([], render_figures(jobs, self.dirname, workers=1))
+        jobs[1] = ('b.pdf', _line_spec, [0, 0, 0])
+        os.remove(os.path.join(self.dirname, 'a.png'))
+        self.assertEqual(['a.png', 'b.pdf'], sorted(render_figures(jobs, self.dirname, workers=1)))
+        self.assertEqual(['a.png'], render_figures(jobs[:1], self.dirname, workers=1, force=True))
+
+    def test_rc_does_not_leak(self):
+        linewidth = matplotlib.rcParams['lines.linewidth']
+        seen = []
+        render_figures([('a.png', _linewidth_spec, seen), ('b.png', _linewidth_spec, seen)], self.dirname,
+                       workers=1, rc=_thick_lines_rc)
+        self.assertEqual([7, 7], seen)
+        self.assertEqual(linewidth, matplotlib.rcParams['lines.linewidth'])
+
+
+if __name__ == '__main__':
+    unittest.main()
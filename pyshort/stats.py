@@ -4,6 +4,8 @@ Statistical functions and helpers.
 '''
 from __future__ import division
 
+import cPickle
+import numpy as np
 import unittest2
 
 
@@ -16,6 +18,349 @@ def tanimoto(set1, set2):
 
 
 
+class SetMatrix(object):
+    """Sets packed as rows of a sparse 0/1 matrix (CSR-style) over a shared vocabulary, for batch tanimoto().
+
+    Row i lists the element ids of sets[i] in indices[indptr[i]:indptr[i + 1]].
+    An inverted index (element id -> rows containing it) is kept as well, for computing intersection counts.
+    To compare queries against a corpus, build the queries with vocabulary=corpus.vocabulary.
+    """
+
+    def __init__(self, sets, vocabulary=None):
+        self.vocabulary = dict(vocabulary) if vocabulary is not None else {}
+        known = len(self.vocabulary)
+        indptr = [0]
+        indices = []
+        for elems in sets:
+            indices.extend(self.vocabulary.setdefault(e, len(self.vocabulary)) for e in elems)
+            indptr.append(len(indices))
+        self.indptr = np.array(indptr, dtype=np.int64)
+        self.indices = np.array(indices, dtype=np.int64)
+        self.sizes = np.diff(self.indptr)
+        self.shared = known  # Element ids below this came from the vocabulary argument.
+
+        rows = np.repeat(np.arange(len(self), dtype=np.int64), self.sizes)
+        order = np.argsort(self.indices, kind='mergesort')
+        self.inv_rows = rows[order]
+        self.inv_ptr = np.concatenate(([0], np.cumsum(np.bincount(self.indices, minlength=len(self.vocabulary)))))
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def pair_counts(self, other):
+        """Number of (element, other row) pairs intersections() expands for each row, the sum of other's
+        row counts of its elements."""
+        seen = self.indices < len(other.inv_ptr) - 1
+        rows = np.repeat(np.arange(len(self), dtype=np.int64), self.sizes)[seen]
+        freqs = np.diff(other.inv_ptr)[self.indices[seen]]
+        return np.bincount(rows, weights=freqs, minlength=len(self)).astype(np.int64)
+
+    def intersections(self, start, stop, other, max_pairs=1 << 21):
+        """Returns a (stop - start, len(other)) array of intersection sizes of rows start:stop with all rows of other.
+
+        other must use the same vocabulary ids, see the class docstring.
+        Each element is expanded into the other rows containing it, at most max_pairs at a time, so temporary arrays
+        take about 40 * max_pairs bytes on top of the result.
+        """
+        elems = self.indices[self.indptr[start]:self.indptr[stop]]
+        rows = np.repeat(np.arange(stop - start, dtype=np.int64), self.sizes[start:stop])
+        # Elements the other matrix has never seen can't be in any of its rows.
+        seen = elems < len(other.inv_ptr) - 1
+        elems, rows = elems[seen], rows[seen]
+        first = other.inv_ptr[elems]
+        lengths = other.inv_ptr[elems + 1] - first
+        ends = np.cumsum(lengths)
+        size = (stop - start) * len(other)
+        counts = None
+        lo = 0
+        while lo < len(elems):
+            # Elements lo:hi expand to at most max_pairs pairs, or just one element if that alone is more.
+            hi = max(lo + 1, np.searchsorted(ends, ends[lo] - lengths[lo] + max_pairs, side='right'))
+            ln, fi = lengths[lo:hi], first[lo:hi]
+            # Expand each (row, element) into (row, other row) for every other row containing the element.
+            offsets = np.arange(ln.sum(), dtype=np.int64) - np.repeat(np.cumsum(ln) - ln - fi, ln)
+            pairs = np.repeat(rows[lo:hi], ln) * len(other) + other.inv_rows[offsets]
+            chunk = np.bincount(pairs, minlength=size)
+            counts = chunk if counts is None else counts + chunk
+            lo = hi
+        if counts is None:
+            counts = np.zeros(size, dtype=np.int64)
+        return counts.reshape(stop - start, len(other))
+
+
+def tanimoto_blocks(sets, other=None, block_size=None, max_pairs=1 << 21):
+    """Yields (start row, similarity block) tiles of the all-pairs tanimoto() matrix, with bounded memory.
+
+    sets and other are SetMatrix instances or lists of sets. If other is None, compares sets with themselves.
+    Each block is a float64 array of shape (rows, len(other)), for rows start:start + rows.
+    block_size is the maximum number of rows per block, by default sized so that a block has about 4 million elements.
+    Blocks are also cut where their rows expand to more than max_pairs (element, other row) pairs, see
+    SetMatrix.intersections(). So peak memory is about 5 arrays of the block size plus 40 * max_pairs bytes,
+    even when many sets share common elements.
+    The similarity of two empty sets is undefined, and returned as nan.
+    """
+    if not isinstance(sets, SetMatrix):
+        sets = SetMatrix(sets)
+    if other is None:
+        other = sets
+    elif not isinstance(other, SetMatrix):
+        other = SetMatrix(other, vocabulary=sets.vocabulary)
+    if block_size is None:
+        block_size = max(1, (1 << 22) // max(len(other), 1))
+    pair_ends = np.cumsum(sets.pair_counts(other))
+    start = 0
+    while start < len(sets):
+        done = pair_ends[start - 1] if start else 0
+        stop = min(start + block_size, np.searchsorted(pair_ends, done + max_pairs, side='right'))
+        stop = max(stop, start + 1)
+        inter = sets.intersections(start, stop, other, max_pairs)
+        union = sets.sizes[start:stop, np.newaxis] + other.sizes[np.newaxis, :] - inter
+        with np.errstate(invalid='ignore', divide='ignore'):
+            yield start, inter / union
+        start = stop
+
+
+def tanimoto_matrix(sets, other=None, block_size=None, max_pairs=1 << 21):
+    """Full all-pairs tanimoto() matrix, of shape (len(sets), len(other)). See tanimoto_blocks()."""
+    return np.vstack([block for start, block in tanimoto_blocks(sets, other, block_size, max_pairs)])
+
+
+def tanimoto_top_k(sets, k, threshold=0.0, other=None, block_size=None, max_pairs=1 << 21):
+    """Top k most similar sets in other (or sets, excluding each set itself) for each set.
+
+    Returns (indexes, similarities), both of shape (len(sets), k), sorted by decreasing similarity.
+    Neighbours with similarity < threshold, and missing ones if there are fewer than k, have index -1 and similarity nan.
+    """
+    self_join = other is None
+    indexes = []
+    similarities = []
+    for start, block in tanimoto_blocks(sets, other, block_size, max_pairs):
+        block = np.where(np.isnan(block), -1.0, block)  # Never selected, even with threshold 0.
+        if self_join:
+            block[np.arange(len(block)), np.arange(start, start + len(block))] = -1.0
+        rows = np.arange(len(block))[:, np.newaxis]
+        kk = min(k, block.shape[1])
+        if kk < block.shape[1]:
+            top = np.argpartition(-block, kk - 1, axis=1)[:, :kk]
+        else:
+            top = np.tile(np.arange(block.shape[1]), (len(block), 1))
+        top = top[rows, np.argsort(-block[rows, top], axis=1, kind='mergesort')]
+        top_sim = block[rows, top]
+        keep = top_sim >= max(threshold, 0.0)
+        idx = np.full((len(block), k), -1, dtype=np.int64)
+        sim = np.full((len(block), k), np.nan)
+        idx[:, :kk] = np.where(keep, top, -1)
+        sim[:, :kk] = np.where(keep, top_sim, np.nan)
+        indexes.append(idx)
+        similarities.append(sim)
+    if not indexes:
+        return np.empty((0, k), dtype=np.int64), np.empty((0, k))
+    return np.vstack(indexes), np.vstack(similarities)
+
+
+class Accumulator(object):
+    """Base for one-pass, mergeable summaries of a stream of numbers.
+
+    add() takes a scalar or a Numpy array (chunk) of any shape. merge() combines partial results,
+    for example from worker processes. Subclasses keep a few numbers in __slots__, so they pickle cheaply.
+    """
+    __slots__ = ()
+
+    def add(self, x):
+        raise NotImplementedError
+
+    def merge(self, other):
+        raise NotImplementedError
+
+    def add_all(self, chunks):
+        """Adds each scalar or chunk from an iterable. Returns self."""
+        for x in chunks:
+            self.add(x)
+        return self
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return '{0}({1})'.format(type(self).__name__, ', '.join('{0}={1}'.format(name, getattr(self, name)) for name in self.__slots__))
+
+
+class Count(Accumulator):
+    __slots__ = ('n',)
+
+    def __init__(self):
+        self.n = 0
+
+    def add(self, x):
+        self.n += np.size(x)
+        return self
+
+    def merge(self, other):
+        self.n += other.n
+        return self
+
+    @property
+    def value(self):
+        return self.n
+
+
+class Sum(Accumulator):
+    __slots__ = ('total',)
+
+    def __init__(self):
+        self.total = 0
+
+    def add(self, x):
+        self.total += np.sum(x) if isinstance(x, np.ndarray) else x
+        return self
+
+    def merge(self, other):
+        self.total += other.total
+        return self
+
+    @property
+    def value(self):
+        return self.total
+
+
+class MinMax(Accumulator):
+    """Minimum and maximum. Value is (inf, -inf) before anything is added."""
+    __slots__ = ('min', 'max')
+
+    def __init__(self):
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def add(self, x):
+        if isinstance(x, np.ndarray):
+            if not x.size:
+                return self
+            lo, hi = x.min(), x.max()
+        else:
+            lo = hi = x
+        self.min = min(self.min, lo)
+        self.max = max(self.max, hi)
+        return self
+
+    def merge(self, other):
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        return self
+
+    @property
+    def value(self):
+        return self.min, self.max
+
+
+class Mean(Accumulator):
+    """Running mean, updated incrementally to avoid a huge sum. Value is nan before anything is added."""
+    __slots__ = ('n', 'mean')
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+
+    def add(self, x):
+        if isinstance(x, np.ndarray):
+            if x.size:
+                self._combine(x.size, float(np.mean(x)))
+        else:
+            self.n += 1
+            self.mean += (x - self.mean) / self.n
+        return self
+
+    def merge(self, other):
+        if other.n:
+            self._combine(other.n, other.mean)
+        return self
+
+    def _combine(self, n, mean):
+        total = self.n + n
+        self.mean += (mean - self.mean) * n / total
+        self.n = total
+
+    @property
+    def value(self):
+        return self.mean if self.n else float('nan')
+
+
+class Variance(Accumulator):
+    """Running count, mean and variance: Welford's algorithm for scalars, Chan et al. for chunks and merges.
+    Value is the population variance (ddof=0), use variance(ddof=1) for the sample variance.
+    """
+    __slots__ = ('n', 'mean', 'm2')
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self.m2 = 0.0  # Sum of squared differences from the mean.
+
+    def add(self, x):
+        if isinstance(x, np.ndarray):
+            if x.size:
+                x = x.astype(np.float64)
+                mean = x.mean()
+                self._combine(x.size, mean, float(((x - mean) ** 2).sum()))
+        else:
+            self.n += 1
+            delta = x - self.mean
+            self.mean += delta / self.n
+            self.m2 += delta * (x - self.mean)
+        return self
+
+    def merge(self, other):
+        if other.n:
+            self._combine(other.n, other.mean, other.m2)
+        return self
+
+    def _combine(self, n, mean, m2):
+        total = self.n + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta ** 2 * self.n * n / total
+        self.n = total
+
+    def variance(self, ddof=0):
+        return self.m2 / (self.n - ddof) if self.n > ddof else float('nan')
+
+    def std(self, ddof=0):
+        return self.variance(ddof) ** 0.5
+
+    @property
+    def value(self):
+        return self.variance()
+
+
+class Summary(Accumulator):
+    """Count, sum, mean, variance, min and max of a stream, in one pass."""
+    __slots__ = ('var', 'sum', 'minmax')
+
+    def __init__(self):
+        self.var = Variance()
+        self.sum = Sum()
+        self.minmax = MinMax()
+
+    def add(self, x):
+        for acc in (self.var, self.sum, self.minmax):
+            acc.add(x)
+        return self
+
+    def merge(self, other):
+        self.var.merge(other.var)
+        self.sum.merge(other.sum)
+        self.minmax.merge(other.minmax)
+        return self
+
+    @property
+    def value(self):
+        return {'count': self.var.n, 'sum': self.sum.value, 'mean': self.var.mean if self.var.n else float('nan'),
+                'variance': self.var.variance(), 'min': self.minmax.min, 'max': self.minmax.max}
+
+
 class StatsTest(unittest2.TestCase):
     def test_tanimoto(self):
         self.assertEqual(tanimoto(set([1,2,3]), set([1,2,3])), 1)
@@ -27,5 +372,93 @@ class StatsTest(unittest2.TestCase):
         self.assertEqual(tanimoto(set(), set([1,2,3])), 0)
         self.assertEqual(tanimoto(set([1,2,3]), set()), 0)
         
+class BatchTanimotoTest(unittest2.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.sets = [set(rng.randint(0, 30, size=rng.randint(0, 10)).tolist()) for i in xrange(40)]
+        self.sets[3] = set()
+
+    def expected(self, sets, other):
+        return np.array([[tanimoto(a, b) if a or b else np.nan for b in other] for a in sets])
+
+    def test_matrix(self):
+        for block_size in [None, 1, 7]:
+            np.testing.assert_allclose(self.expected(self.sets, self.sets), tanimoto_matrix(self.sets, block_size=block_size))
+        for max_pairs in [1, 5, 50]:
+            np.testing.assert_allclose(self.expected(self.sets, self.sets), tanimoto_matrix(self.sets, max_pairs=max_pairs))
+
+    def test_blocks_bounded_by_pairs(self):
+        sets = SetMatrix([set(range(5)) | set([i + 100]) for i in xrange(50)])  # 5 elements shared by all rows.
+        self.assertEqual([5 * 50 + 1] * 50, sets.pair_counts(sets).tolist())
+        starts = [start for start, block in tanimoto_blocks(sets, max_pairs=1000)]
+        self.assertEqual(range(0, 50, 3), starts)
+        np.testing.assert_allclose(tanimoto_matrix(sets), tanimoto_matrix(sets, max_pairs=1000))
+        self.assertTrue(np.array_equal(sets.intersections(0, 50, sets), sets.intersections(0, 50, sets, max_pairs=7)))
+
+    def test_other(self):
+        other = [set(['x', 1, 2]), set([5]), set()]
+        np.testing.assert_allclose(self.expected(self.sets, other), tanimoto_matrix(self.sets, other))
+
+    def test_top_k(self):
+        expected = self.expected(self.sets, self.sets)
+        indexes, sims = tanimoto_top_k(self.sets, 3, threshold=0.1, block_size=6)
+        for i in xrange(len(self.sets)):
+            row = [(expected[i, j], j) for j in xrange(len(self.sets)) if j != i and expected[i, j] >= 0.1]
+            best = sorted(row, key=lambda sj: -sj[0])[:3]
+            self.assertEqual([sj[0] for sj in best], [s for s in sims[i] if not np.isnan(s)])
+            for j, s in zip(indexes[i], sims[i]):
+                if j >= 0:
+                    self.assertEqual(expected[i, j], s)
+                    self.assertNotEqual(i, j)
+
+    def test_top_k_more_than_available(self):
+        indexes, sims = tanimoto_top_k([set([1]), set([1, 2])], 5)
+        self.assertEqual([[1, -1, -1, -1, -1], [0, -1, -1, -1, -1]], indexes.tolist())
+        self.assertEqual(0.5, sims[0, 0])
+
+
+class AccumulatorTest(unittest2.TestCase):
+    def setUp(self):
+        self.data = np.random.RandomState(0).normal(5, 2, size=1000)
+
+    def check_all_ways(self, make, expected):
+        """Adds data as scalars, as chunks, and as merged partial results."""
+        by_scalar = make().add_all(self.data.tolist())
+        by_chunk = make().add_all(np.array_split(self.data, 7))
+        parts = [make().add_all(chunk) for chunk in np.array_split(self.data, 3)]
+        merged = parts[0].merge(parts[1]).merge(make()).merge(parts[2])
+        unpickled = cPickle.loads(cPickle.dumps(merged, 2))
+        for acc in (by_scalar, by_chunk, merged, unpickled):
+            np.testing.assert_allclose(expected, acc.value)
+
+    def test_count(self):
+        self.check_all_ways(Count, 1000)
+
+    def test_sum(self):
+        self.check_all_ways(Sum, self.data.sum())
+
+    def test_minmax(self):
+        self.check_all_ways(MinMax, (self.data.min(), self.data.max()))
+
+    def test_mean(self):
+        self.check_all_ways(Mean, self.data.mean())
+
+    def test_variance(self):
+        self.check_all_ways(Variance, self.data.var())
+        self.assertAlmostEqual(self.data.var(ddof=1), Variance().add(self.data).variance(ddof=1))
+
+    def test_summary(self):
+        summary = Summary().add_all(np.array_split(self.data, 5))
+        summary = cPickle.loads(cPickle.dumps(summary, 2))
+        self.assertEqual(1000, summary.value['count'])
+        self.assertAlmostEqual(self.data.std(), summary.var.std())
+        self.assertEqual(self.data.max(), summary.value['max'])
+
+    def test_empty(self):
+        self.assertTrue(np.isnan(Mean().value))
+        self.assertTrue(np.isnan(Variance().add(np.array([])).value))
+        self.assertEqual(0, Count().add(np.array([])).value)
+
+
 if __name__ == '__main__':
     unittest2.main()
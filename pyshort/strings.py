@@ -4,7 +4,13 @@ from future_builtins import *  # ascii, filter, hex, map, oct, zip
 
 import cStringIO
 import gzip
+import itertools
+from multiprocessing.pool import ThreadPool
+import numpy as np
 import sys
+import tempfile
+import unittest
+import zlib
 
 
 def printf(fmt=None, *args, **kwargs):
@@ -14,12 +20,85 @@ def printf(fmt=None, *args, **kwargs):
         print()
 
 
-def gunzip(gzdata):
+def gunzip(gzdata, max_size=None):
     """Uncompresses gzip file data given as a string. The data is assumed to contain full gzip headers."""
+    if max_size is not None:
+        return b''.join(gunzip_iter(gzdata, max_size=max_size))
     with gzip.GzipFile(mode='rb', fileobj=cStringIO.StringIO(gzdata)) as f:
         return f.read()
 
 
+def gunzip_iter(gzdata, chunk_size=1 << 16, max_size=None):
+    """Yields uncompressed chunks of at most chunk_size bytes from gzip data given as a string or file-like object.
+
+    Handles concatenated gzip members (like gzip.GzipFile does) and zero padding between them.
+    Raises ValueError if the output would exceed max_size bytes, without decompressing more than that,
+    and EOFError if the data ends inside a member.
+    """
+    if hasattr(gzdata, 'read'):
+        pieces = iter(lambda: gzdata.read(chunk_size), b'')
+    else:
+        pieces = (gzdata[i:i + chunk_size] for i in xrange(0, len(gzdata), chunk_size))
+    total = 0
+    d = None  # Decompressor of the current member, None between members.
+    for pending in pieces:
+        while pending:
+            if d is None:
+                pending = pending.lstrip(b'\x00')
+                if not pending:
+                    break
+                d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            while True:
+                # Limit output per call, so a small input cannot expand into a huge string.
+                out = d.decompress(pending, chunk_size)
+                pending = d.unconsumed_tail
+                total += len(out)
+                if max_size is not None and total > max_size:
+                    raise ValueError('Uncompressed data is larger than max_size={0} bytes.'.format(max_size))
+                if out:
+                    yield out
+                # A full chunk of output may leave more buffered in the decompressor.
+                if d.unused_data or (not pending and len(out) < chunk_size):
+                    break
+            if d.unused_data:
+                pending = d.unused_data  # Start of the next member.
+                d = None
+    if d is not None and not _member_finished(d):
+        raise EOFError('Compressed data ended before the end-of-stream marker was reached.')
+
+
+def _member_finished(d):
+    """After the end of a gzip member, zlib passes further input to unused_data, before it consumes it."""
+    probe = d.copy()
+    try:
+        probe.decompress(b'\x00')
+    except zlib.error:
+        return False
+    return probe.unused_data == b'\x00'
+
+
+def gunzip_to_file(gzdata, fileobj, chunk_size=1 << 16, max_size=None):
+    """Writes uncompressed gzip data to a file-like object with gunzip_iter(), returns the number of bytes."""
+    total = 0
+    for chunk in gunzip_iter(gzdata, chunk_size, max_size):
+        fileobj.write(chunk)
+        total += len(chunk)
+    return total
+
+
+def gunzip_many(blobs, workers=4, max_size=None):
+    """Uncompresses a list of independent gzip strings in a thread pool, returns a list of strings.
+
+    zlib releases the GIL while decompressing, so threads run in parallel without pickling the data.
+    """
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(lambda blob: gunzip(blob, max_size=max_size), blobs)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def color(text, col='r'):
     """Returns text surrounded by Bash terminal colour codes. Useful for easier to notice errors in long outputs."""
     colorcode = {'r': '1;31',  # light red
@@ -53,6 +132,72 @@ def tabulate(rows, sep=' ', end='\n', join=True):
         return text_rows
 
 
+def column_widths(rows, block_size=10000):
+    """Returns the maximum unicode() length of each column, in one pass over an iterable of rows.
+
+    Rows are processed in blocks, with the lengths of each column block computed at once by np.char.str_len().
+    """
+    widths = None
+    rows = iter(rows)
+    while True:
+        block = list(itertools.islice(rows, block_size))
+        if not block:
+            return widths or []
+        num_cols = len(block[0])
+        assert all(len(r) == num_cols for r in block), 'All rows must have the same number of columns.'
+        block_widths = [int(np.char.str_len(np.array([unicode(c) for c in col], dtype=np.unicode_)).max())
+                        for col in zip(*block)]
+        if widths is None:
+            widths = block_widths
+        else:
+            assert len(widths) == num_cols, 'All rows must have the same number of columns.'
+            widths = [max(w, bw) for w, bw in zip(widths, block_widths)]
+
+
+def tabulate_to_files(rows, files=None, sep=' ', end='\n', sample=None, overflow='extend', block_size=10000):
+    """Writes an ASCII-formatted table to file objects, like print(tabulate(rows, sep, end), file=f) for each f.
+
+    The table is never built in memory: rows are formatted and written block_size at a time.
+    Without sample, rows must be a sequence, which is read twice: once for column_widths(), once for writing.
+    Iterators raise ValueError then, since the second pass would write nothing.
+    With sample=n, widths come from the first n rows only and rows can be any iterator.
+    Longer cells after the sample either extend their row (overflow='extend') or are cut (overflow='truncate').
+    files defaults to [sys.stdout].
+    """
+    assert overflow in ('extend', 'truncate'), 'overflow must be "extend" or "truncate".'
+    if files is None:
+        files = [sys.stdout]
+    if sample is None:
+        if iter(rows) is rows:
+            raise ValueError('rows is an iterator and can only be read once, give sample to tabulate it.')
+        widths = column_widths(rows, block_size)
+        rows = iter(rows)
+    else:
+        rows = iter(rows)
+        head = list(itertools.islice(rows, sample))
+        widths = column_widths(head, block_size)
+        rows = itertools.chain(head, rows)
+    first = True
+    while True:
+        block = list(itertools.islice(rows, block_size))
+        if not block:
+            break
+        lines = []
+        for r in block:
+            assert len(r) == len(widths), 'All rows must have the same number of columns.'
+            cells = [unicode(c) for c in r]
+            if overflow == 'truncate':
+                cells = [c[:w] for c, w in zip(cells, widths)]
+            lines.append(sep.join(c.ljust(w) for c, w in zip(cells, widths)))
+        text = ('' if first else end) + end.join(lines)
+        first = False
+        for f in files:
+            f.write(text)
+    if not first:
+        for f in files:
+            f.write('\n')
+
+
 # Global state for building up a table in quick scripts.
 
 _TABLE_ROWS = []
@@ -65,19 +210,121 @@ def table_row(cols):
 
 
 def table_print(file=None, files=None, **kwargs):
+    """Writes the rows collected by table_row() to file or files (stderr by default) and clears them.
+    Other keyword arguments go to tabulate_to_files(). The join argument of tabulate() is accepted but ignored,
+    as it only selected the type of the return value, which table_print() never returned.
+    """
     global _TABLE_ROWS
 
+    kwargs.pop('join', None)
     if file and files:
         raise RuntimeError('Only one out of file and files can be given at a time.')
     if not files:
         files = [file] if file else [sys.stderr]
 
-    table = tabulate(_TABLE_ROWS, **kwargs)
-    for fname in files:
-        if isinstance(fname, basestring):
-            with open(fname, 'w') as f:
-                print(table, file=f)
-        else:
-            # Expecting a file-like object or stream.
-            print(table, file=fname)
+    # Written row by row with tabulate_to_files(), without building the whole table as a string.
+    opened = [open(fname, 'w') for fname in files if isinstance(fname, basestring)]
+    try:
+        streams = [fname for fname in files if not isinstance(fname, basestring)]  # File-like objects or streams.
+        tabulate_to_files(_TABLE_ROWS, opened + streams, **kwargs)
+    finally:
+        for f in opened:
+            f.close()
     _TABLE_ROWS = []
+
+
+def _gzip(data):
+    buf = cStringIO.StringIO()
+    with gzip.GzipFile(mode='wb', fileobj=buf) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+class GunzipTest(unittest.TestCase):
+    def setUp(self):
+        self.data = b''.join(str(i) for i in xrange(100000))
+        self.gzdata = _gzip(self.data)
+
+    def test_chunks(self):
+        for chunk_size in [7, 1000, 1 << 16, 1 << 24]:
+            chunks = list(gunzip_iter(self.gzdata, chunk_size))
+            self.assertEqual(self.data, b''.join(chunks))
+            self.assertLessEqual(max(len(c) for c in chunks), chunk_size)
+        self.assertEqual(self.data, b''.join(gunzip_iter(cStringIO.StringIO(self.gzdata), 333)))
+        self.assertEqual(b'', b''.join(gunzip_iter(b'')))
+
+    def test_multi_member(self):
+        gzdata = self.gzdata + _gzip(b'') + _gzip(b'abc') + b'\x00' * 10 + _gzip(b'def') + b'\x00' * 3
+        for chunk_size in [5, 100, 1 << 16]:
+            self.assertEqual(self.data + b'abcdef', b''.join(gunzip_iter(gzdata, chunk_size)))
+        self.assertEqual(gunzip(gzdata), gunzip(gzdata, max_size=1 << 30))
+
+    def test_truncated(self):
+        self.assertRaises(EOFError, lambda: list(gunzip_iter(self.gzdata[:-5])))
+        self.assertRaises(EOFError, lambda: list(gunzip_iter(self.gzdata[:len(self.gzdata) // 2])))
+        self.assertRaises(EOFError, lambda: list(gunzip_iter(self.gzdata + self.gzdata[:20])))
+
+    def test_max_size(self):
+        bomb = _gzip(b'\x00' * (10 << 20))
+        self.assertRaises(ValueError, gunzip, bomb, max_size=1 << 20)
+        self.assertEqual(len(self.data), len(gunzip(self.gzdata, max_size=len(self.data))))
+
+    def test_to_file_and_many(self):
+        f = tempfile.TemporaryFile()
+        self.assertEqual(len(self.data), gunzip_to_file(self.gzdata, f))
+        f.seek(0)
+        self.assertEqual(self.data, f.read())
+        blobs = [_gzip(str(i) * i) for i in xrange(20)]
+        self.assertEqual([str(i) * i for i in xrange(20)], gunzip_many(blobs, workers=3))
+
+
+class TabulateToFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.rows = [['name', 'value', 'x'], ['a', 1.5, None], ['long name', 100, True]] * 7
+
+    def printed(self, rows, **kwargs):
+        f = cStringIO.StringIO()
+        print(tabulate(rows, **kwargs), file=f)
+        return f.getvalue()
+
+    def written(self, rows, **kwargs):
+        files = [cStringIO.StringIO(), cStringIO.StringIO()]
+        tabulate_to_files(rows, files, **kwargs)
+        self.assertEqual(files[0].getvalue(), files[1].getvalue())
+        return files[0].getvalue()
+
+    def test_same_as_tabulate(self):
+        for block_size in [1, 2, 5, 10000]:
+            self.assertEqual(self.printed(self.rows), self.written(self.rows, block_size=block_size))
+            self.assertEqual(self.printed(self.rows, sep=' & ', end='\\\\\n'),
+                             self.written(self.rows, sep=' & ', end='\\\\\n', block_size=block_size))
+        self.assertEqual(self.printed(self.rows), self.written(iter(self.rows), sample=len(self.rows)))
+        self.assertEqual('', self.written([]))
+        self.assertEqual([9, 5, 4], column_widths(self.rows, block_size=2))
+        self.assertEqual(self.printed([['', 'a'], ['', 'b']]), self.written([['', 'a'], ['', 'b']]))
+
+    def test_sample(self):
+        rows = [['a', 'b'], ['ccc', 'd'], ['eeeee', 'f']]
+        self.assertEqual('a   b\nccc d\neeeee f\n', self.written(iter(rows), sample=2))
+        self.assertEqual('a   b\nccc d\neee f\n', self.written(iter(rows), sample=2, overflow='truncate'))
+        self.assertRaises(ValueError, tabulate_to_files, iter(rows), [cStringIO.StringIO()])
+        self.assertRaises(ValueError, tabulate_to_files, (r for r in rows), [cStringIO.StringIO()])
+
+    def test_table_print(self):
+        for row in self.rows:
+            table_row(row)
+        f = cStringIO.StringIO()
+        table_print(file=f)
+        self.assertEqual(self.printed(self.rows), f.getvalue())
+        self.assertEqual([], _TABLE_ROWS)
+
+    def test_table_print_join(self):
+        for row in self.rows:
+            table_row(row)
+        f = cStringIO.StringIO()
+        table_print(file=f, join=False)
+        self.assertEqual(self.printed(self.rows), f.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()